@@ -10,13 +10,55 @@ EMAIL_SENDER = ""
 EMAIL_PASSWORD = ""
 EMAIL_RECEIVER = "" # Can be the same as sender
 
+# --- AI SUMMARY ---
+# Optional: set to True to have Gemini return only its story picks and summaries
+# as JSON and render the news digest HTML locally (faster, and links are always exact).
+GEMINI_STRUCTURED_OUTPUT = False
+
+# Gemini models in order of preference, with each model's requests-per-minute,
+# tokens-per-minute and requests-per-day limits (set these to your plan's quotas).
+# Calls move to the next model when one runs out of budget, is slow or is rate limited.
+GEMINI_MODELS = {
+    "gemini-2.5-flash": {"rpm": 10, "tpm": 250000, "rpd": 250},
+    "gemini-2.5-flash-lite": {"rpm": 15, "tpm": 250000, "rpd": 1000},
+}
+GEMINI_MAX_CONCURRENCY = 2    # Gemini requests allowed in flight at once
+GEMINI_LATENCY_THRESHOLD = 30 # seconds; models slower than this are used only when no faster one is free
+GEMINI_MAX_WAIT = 10          # seconds to wait for budget before switching models
+GEMINI_REQUEST_TIMEOUT = 300  # seconds before a call is abandoned and the next model is tried
+
 # --- IMAP SETTINGS (for reading replies) ---
 IMAP_SERVER = "imap.gmail.com" # Or your provider's IMAP server
 IMAP_PORT = 993
 
 # --- CUSTOMIZE YOUR DIGEST ---
 
-# Add your specific National Weather Service (NWS) forecast URL here.
+# Sections to include, in the order they appear in the email. Built-in sources are
+# "financial", "weather", "nasa", "wikipedia", "reddit", "rss" and "xkcd". The AI news
+# digest (built from "reddit" and "rss") appears where the first of those is listed.
+# You can also add your own Source subclass as "module_name.ClassName".
+DIGEST_SOURCES = ["financial", "weather", "nasa", "wikipedia", "reddit", "rss", "xkcd"]
+
+# How many sources are fetched in parallel, and how long (in seconds) to wait for them.
+SOURCE_MAX_WORKERS = 4
+SOURCE_TIMEOUT = 120
+
+# Optional: reuse a source's last result for this many seconds instead of refetching.
+SOURCE_CACHE_TTLS = {
+    # "wikipedia": 3600,
+}
+
+# Locations for the weather report. The NWS forecast URL for each location is
+# looked up once and cached, and forecasts are only refetched when they expire.
+WEATHER_LOCATIONS = [
+    # {"name": "Home", "lat": 38.8894, "lon": -77.0352},
+]
+
+# Also show the next few hours of each location's hourly forecast.
+NWS_INCLUDE_HOURLY = False
+
+# Alternatively, a single National Weather Service (NWS) forecast URL
+# (used when WEATHER_LOCATIONS is empty).
 NWS_FORECAST_URL = ""
 
 # Section for Reddit communities (using the .json endpoint)
@@ -36,3 +78,7 @@ FINANCIAL_ASSETS = {
     "S&P 500": "SPY",
     "Bitcoin": "BINANCE:BTCUSDT",
 }
+
+# Record each run's quotes in a local database (market_history.db) and show
+# 7/30-day changes, moving averages and sparklines computed from that history.
+MARKET_HISTORY_ENABLED = True
@@ -0,0 +1,515 @@
+"""Synthetic load test for the daily digest, run entirely against local stand-in servers.
+
+Starts stand-ins for Finnhub, NWS, Wikipedia, xkcd/NASA/RSS feeds, Reddit JSON,
+Gemini, IMAP and SMTP in a separate process, points main.py at them, runs the
+digest a few times and reports throughput, p50/p99 stage latencies and peak RSS.
+
+Example:
+    python loadtest.py --feeds 500 --tickers 200 --recipients 50 --latency 0.05 --error-rate 0.02
+"""
+import argparse
+import imaplib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import smtplib
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from email.mime.text import MIMEText
+from email.utils import format_datetime
+from datetime import datetime, timezone
+from functools import wraps
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import requests
+
+
+# --- Stand-in servers ---
+# Everything below runs in the child process started by start_stand_ins().
+
+STATS = Counter()
+STATS_LOCK = threading.Lock()
+
+
+def count(key):
+    with STATS_LOCK:
+        STATS[key] += 1
+
+
+def inject_error(protocol, settings):
+    """Returns True (and counts it) when this request should fail, per settings['error_rate']."""
+    if random.random() < settings['error_rate']:
+        count(f"{protocol}.errors")
+        return True
+    return False
+
+
+def filler(size):
+    """Returns roughly `size` characters of filler text."""
+    words = ("market", "river", "signal", "orbit", "harbor", "lantern", "ledger", "summit")
+    text = " ".join(words[i % len(words)] for i in range(size // 7 + 1))
+    return text[:size]
+
+
+class StandInHTTPHandler(BaseHTTPRequestHandler):
+    """Routes requests for every HTTP upstream by path prefix."""
+
+    protocol_version = "HTTP/1.1"
+    settings = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.request_body = self.rfile.read(length)
+        self.handle_request()
+
+    def handle_request(self):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        if parsed.path == "/__stats":
+            with STATS_LOCK:
+                return self.send(200, json.dumps(dict(STATS)), "application/json")
+
+        upstream = parsed.path.split('/')[1]
+        # Reddit listings keep their real /r/... paths so multi-subreddit grouping applies.
+        upstream = "reddit" if upstream == "r" else upstream
+        count(f"http.{upstream}")
+        time.sleep(max(0.0, random.gauss(self.settings['latency'], self.settings['latency'] / 4)))
+        if inject_error("http", self.settings):
+            return self.send(429 if upstream == "gemini" else 500, "stand-in error", "text/plain")
+
+        route = getattr(self, f"route_{upstream}", None)
+        if route is None:
+            return self.send(404, "not found", "text/plain")
+        route(parsed.path, query)
+
+    def send(self, status, body, content_type, headers=None):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route_finnhub(self, path, query):
+        price = random.uniform(10, 500)
+        change = random.uniform(-5, 5)
+        self.send(200, json.dumps({"c": price, "d": change, "dp": change / price * 100}), "application/json")
+
+    def route_nws(self, path, query):
+        base = f"http://{self.headers['Host']}/nws"
+        if path.startswith("/nws/points/"):
+            gridpoint = path.rsplit('/', 1)[1]
+            body = {"properties": {
+                "forecast": f"{base}/gridpoints/{gridpoint}/forecast",
+                "forecastHourly": f"{base}/gridpoints/{gridpoint}/forecast/hourly",
+            }}
+            return self.send(200, json.dumps(body), "application/geo+json")
+        start = datetime.now(timezone.utc)
+        periods = [{
+            "name": f"Period {i}",
+            "startTime": start.isoformat(),
+            "temperature": random.randint(20, 90),
+            "temperatureUnit": "F",
+            "shortForecast": "Partly Cloudy",
+            "detailedForecast": filler(self.settings['text_size']),
+        } for i in range(14 if path.endswith("/forecast") else 156)]
+        self.send(200, json.dumps({"properties": {"periods": periods}}), "application/geo+json",
+                  {"Cache-Control": f"public, max-age={self.settings['nws_max_age']}"})
+
+    def route_wikipedia(self, path, query):
+        if path.endswith("/wiki/Main_Page"):
+            body = ('<html><body><div id="mp-tfa"><p><b><a href="/wiki/Stand-in_Article">Stand-in Article</a></b> '
+                    f'{filler(self.settings["text_size"])}</p></div></body></html>')
+            return self.send(200, body, "text/html")
+        body = {"extract": filler(self.settings['text_size']), "thumbnail": {"source": "http://example.com/thumb.jpg"}}
+        self.send(200, json.dumps(body), "application/json")
+
+    def route_xkcd(self, path, query):
+        updated = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        body = f"""<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>xkcd.com</title><id>https://xkcd.com/</id><updated>{updated}</updated>
+<entry><title>Stand-in Comic</title><link href="https://xkcd.com/1/" /><updated>{updated}</updated><id>https://xkcd.com/1/</id>
+<summary type="html">&lt;img src="https://imgs.xkcd.com/comics/stand_in.png" title="{filler(80)}" alt="Stand-in" /&gt;</summary></entry>
+</feed>"""
+        self.send(200, body, "application/atom+xml")
+
+    def route_nasa(self, path, query):
+        self.send(200, self.rss_feed("NASA Image of the Day", 1, enclosure=True), "application/rss+xml")
+
+    def route_rss(self, path, query):
+        self.send(200, self.rss_feed(f"Feed {path.rsplit('/', 1)[1]}", self.settings['items']), "application/rss+xml")
+
+    def rss_feed(self, title, items, enclosure=False):
+        pub_date = format_datetime(datetime.now(timezone.utc))
+        entries = "".join(f"""
+<item><title>{escape(title)} story {i}</title><link>http://example.com/{i}</link>
+<description>{filler(self.settings['text_size'])}</description><pubDate>{pub_date}</pubDate>
+{'<enclosure url="http://example.com/image.jpg" type="image/jpeg" length="1" />' if enclosure else ''}</item>"""
+                          for i in range(items))
+        return f"""<?xml version="1.0"?>
+<rss version="2.0"><channel><title>{escape(title)}</title><link>http://example.com/</link>{entries}
+</channel></rss>"""
+
+    def route_reddit(self, path, query):
+        subreddits = path.split('/')[2].split('+')
+        limit = int(query.get('limit', ['25'])[0])
+        children = [{"kind": "t3", "data": {
+            "subreddit": subreddits[i % len(subreddits)],
+            "title": f"Post {i} in r/{subreddits[i % len(subreddits)]}",
+            "permalink": f"/r/{subreddits[i % len(subreddits)]}/comments/{i}/",
+            "is_self": i % 2 == 0,
+            "selftext": filler(self.settings['text_size']),
+            # Real listings carry large preview/media blobs the digest never uses.
+            "preview": {"images": [{"source": {"url": "http://example.com/p.jpg"}, "blob": filler(4000)}]},
+        }} for i in range(limit)]
+        self.send(200, json.dumps({"kind": "Listing", "data": {"children": children}}), "application/json")
+
+    def route_gemini(self, path, query):
+        request = json.loads(self.request_body or b"{}")
+        prompt = request.get("contents", [{}])[0].get("parts", [{}])[0].get("text", "")
+        if request.get("generationConfig", {}).get("responseMimeType") == "application/json":
+            stories = [{"id": str(i), "summary": filler(self.settings['gemini_summary_size'])}
+                       for i in range(1, self.settings['gemini_stories'] + 1)]
+            text = json.dumps({"categories": [{"name": "News", "stories": stories}]})
+        else:
+            stories = "".join(f'<li><a href="http://example.com/{i}">Story {i}</a>'
+                              f'<p>{filler(self.settings["gemini_summary_size"])}</p></li>'
+                              for i in range(self.settings['gemini_stories']))
+            text = f"<h2>News</h2><ul>{stories}</ul>"
+        prompt_tokens = len(prompt.split())
+        body = {
+            "candidates": [{"content": {"parts": [{"text": text}]}}],
+            "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": len(text.split()),
+                              "totalTokenCount": prompt_tokens + len(text.split())},
+        }
+        self.send(200, json.dumps(body), "application/json")
+
+
+class StandInIMAPHandler(socketserver.StreamRequestHandler):
+    """Just enough IMAP4rev1 for imaplib's login/select/search/fetch/logout."""
+
+    settings = None
+
+    def reply(self, line):
+        self.wfile.write(line.encode('utf-8') + b"\r\n")
+
+    def handle(self):
+        count("imap.connections")
+        self.reply("* OK IMAP4rev1 stand-in ready")
+        for raw in self.rfile:
+            tag, command, *args = raw.decode('utf-8').strip().split(' ', 2) + [""]
+            command = command.upper()
+            time.sleep(self.settings['latency'])
+            if command not in ("CAPABILITY", "LOGOUT") and inject_error("imap", self.settings):
+                self.reply(f"{tag} NO [UNAVAILABLE] stand-in error")
+                continue
+            if command == "CAPABILITY":
+                self.reply("* CAPABILITY IMAP4rev1")
+            elif command == "SELECT":
+                self.reply("* 1 EXISTS")
+            elif command == "SEARCH":
+                self.reply("* SEARCH 1" if self.settings['feedback'] else "* SEARCH")
+            elif command == "FETCH":
+                message = MIMEText("Show more science stories, fewer sports.\n\nOn Monday the digest wrote:\n> old")
+                message['Subject'] = "Re: Your Daily Digest"
+                data = message.as_bytes()
+                self.wfile.write(f"* 1 FETCH (RFC822 {{{len(data)}}}\r\n".encode('utf-8') + data + b")\r\n")
+            elif command == "LOGOUT":
+                self.reply("* BYE logging out")
+                self.reply(f"{tag} OK LOGOUT completed")
+                return
+            self.reply(f"{tag} OK {command} completed")
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough ESMTP for smtplib's ehlo/login/sendmail/quit (STARTTLS is skipped by the driver)."""
+
+    settings = None
+
+    def reply(self, line):
+        self.wfile.write(line.encode('utf-8') + b"\r\n")
+
+    def handle(self):
+        count("smtp.connections")
+        self.reply("220 stand-in ESMTP")
+        while True:
+            raw = self.rfile.readline()
+            if not raw:
+                return
+            command = raw.decode('utf-8').strip().split(' ', 1)[0].upper()
+            if command == "EHLO":
+                self.reply("250-stand-in")
+                self.reply("250 AUTH PLAIN")
+            elif command in ("AUTH", "MAIL", "RCPT") and inject_error("smtp", self.settings):
+                self.reply("451 Stand-in temporary failure")
+            elif command == "AUTH":
+                self.reply("235 Authentication successful")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for line in self.rfile:
+                    if line == b".\r\n":
+                        break
+                    size += len(line)
+                time.sleep(self.settings['latency'])
+                if inject_error("smtp", self.settings):
+                    self.reply("554 Stand-in transaction failed")
+                    continue
+                count("smtp.messages")
+                with STATS_LOCK:
+                    STATS["smtp.bytes"] += size
+                self.reply("250 Queued")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_stand_ins(settings, ports_queue):
+    """Child-process entry point: starts every stand-in and reports their ports."""
+    random.seed(settings['seed'])
+    StandInHTTPHandler.settings = settings
+    StandInIMAPHandler.settings = settings
+    StandInSMTPHandler.settings = settings
+    http_server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHTTPHandler)
+    http_server.daemon_threads = True
+    imap_server = ThreadingTCPServer(("127.0.0.1", 0), StandInIMAPHandler)
+    smtp_server = ThreadingTCPServer(("127.0.0.1", 0), StandInSMTPHandler)
+    for server in (imap_server, smtp_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ports_queue.put({
+        "http": http_server.server_address[1],
+        "imap": imap_server.server_address[1],
+        "smtp": smtp_server.server_address[1],
+    })
+    http_server.serve_forever()
+
+
+def start_stand_ins(settings):
+    """Starts the stand-in servers in a separate process so they don't count toward peak RSS."""
+    ports_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_stand_ins, args=(settings, ports_queue), daemon=True)
+    process.start()
+    return process, ports_queue.get(timeout=30)
+
+
+# --- Load-test driver ---
+
+class PlainIMAP(imaplib.IMAP4):
+    """IMAP4_SSL replacement for talking to the plaintext stand-in."""
+
+    def __init__(self, host='', port=imaplib.IMAP4_PORT, ssl_context=None, timeout=None):
+        super().__init__(host, port, timeout=timeout)
+
+
+def configure_digest(main, args, ports, workdir):
+    """Points main.py and its config at the stand-ins and a scratch directory."""
+    base = f"http://127.0.0.1:{ports['http']}"
+    main.FINNHUB_API_URL = f"{base}/finnhub"
+    main.NWS_API_URL = f"{base}/nws"
+    main.WIKIPEDIA_URL = f"{base}/wikipedia"
+    main.XKCD_FEED_URL = f"{base}/xkcd/atom.xml"
+    main.NASA_FEED_URL = f"{base}/nasa/rss"
+    main.GEMINI_API_URL = f"{base}/gemini"
+    main.FEEDBACK_CONTEXT_FILE = os.path.join(workdir, "feedback_context.md")
+    main.SOURCE_CACHE_FILE = os.path.join(workdir, "source_cache.json")
+    main.MARKET_HISTORY_DB = os.path.join(workdir, "market_history.db")
+    main.WEATHER_CACHE_FILE = os.path.join(workdir, "weather_cache.json")
+    main.LLM_USAGE_FILE = os.path.join(workdir, "llm_usage.json")
+
+    config = main.config
+    config.GEMINI_API_KEY = "stand-in"
+    config.FINNHUB_API_KEY = "stand-in"
+    config.FINANCIAL_ASSETS = {f"Asset {i}": f"SYM{i}" for i in range(args.tickers)}
+    config.WEATHER_LOCATIONS = [
+        {"name": f"Location {i}", "lat": 30 + i * 0.1, "lon": -90 - i * 0.1} for i in range(args.locations)
+    ]
+    config.NWS_INCLUDE_HOURLY = args.hourly
+    config.REDDIT_JSON_FEEDS = {
+        f"Subreddit {i}": f"{base}/r/sub{i}/top/.json?t=day" for i in range(args.subreddits)
+    }
+    config.GENERAL_RSS_FEEDS = {f"Feed {i}": f"{base}/rss/{i}" for i in range(args.feeds)}
+    config.DIGEST_SOURCES = list(main.DEFAULT_SOURCES)
+    config.SOURCE_CACHE_TTLS = {}
+    config.GEMINI_STRUCTURED_OUTPUT = args.structured
+    config.SMTP_SERVER = "127.0.0.1"
+    config.SMTP_PORT = ports['smtp']
+    config.IMAP_SERVER = "127.0.0.1"
+    config.IMAP_PORT = ports['imap']
+    config.EMAIL_SENDER = "digest@example.com"
+    config.EMAIL_PASSWORD = "stand-in"
+    config.EMAIL_RECEIVER = "reader0@example.com"
+
+    # The stand-ins speak plaintext, so skip TLS on both mail connections.
+    imaplib.IMAP4_SSL = PlainIMAP
+    smtplib.SMTP.starttls = lambda self, *args, **kwargs: (220, b"TLS skipped")
+
+
+def fan_out_send(main, recipients):
+    """Makes each digest go to every simulated recipient, one send_email call per recipient."""
+    send_email = main.send_email
+
+    @wraps(send_email)
+    def send_to_all(*args, **kwargs):
+        for recipient in recipients:
+            main.config.EMAIL_RECEIVER = recipient
+            send_email(*args, **kwargs)
+
+    main.send_email = send_to_all
+
+
+def instrument(main, timings):
+    """Wraps main.py's stage functions so each call's duration is recorded under the stage name."""
+    def timed(name, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.setdefault(name, []).append(time.perf_counter() - start)
+        return wrapper
+
+    stages = {
+        "feedback": "refresh_feedback_context",
+        "fetch": "run_sources",
+        "ai_summary": "get_ai_summary",
+        "ai_summary_structured": "get_structured_ai_summary",
+        "render": "render_digest",
+        "send": "send_email",
+    }
+    for stage, function_name in stages.items():
+        setattr(main, function_name, timed(stage, getattr(main, function_name)))
+
+    run_sources = main.run_sources
+
+    @wraps(run_sources)
+    def run_sources_with_source_timings(sources):
+        results, source_timings = run_sources(sources)
+        for name, elapsed in source_timings.items():
+            timings.setdefault(f"source.{name}", []).append(elapsed)
+        return results, source_timings
+
+    main.run_sources = run_sources_with_source_timings
+    main.main = timed("total", main.main)
+
+
+def fetch_stats(ports):
+    return requests.get(f"http://127.0.0.1:{ports['http']}/__stats").json()
+
+
+def print_report(args, timings, elapsed, stats):
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if sys.platform == "darwin":
+        peak_rss_mb /= 1024  # ru_maxrss is in bytes on macOS
+    http_requests = sum(value for key, value in stats.items() if key.startswith("http.") and key != "http.errors")
+
+    print()
+    print(f"Runs: {args.runs}  feeds: {args.feeds}  tickers: {args.tickers}  subreddits: {args.subreddits}  "
+          f"locations: {args.locations}  recipients: {args.recipients}")
+    print(f"Latency: {args.latency * 1000:.0f} ms  error rate: {args.error_rate:.1%}  structured: {args.structured}")
+    print()
+    print(f"{'stage':<28}{'calls':>7}{'p50 (s)':>10}{'p99 (s)':>10}{'max (s)':>10}")
+    for stage in sorted(timings):
+        values = np.array(timings[stage])
+        print(f"{stage:<28}{values.size:>7}{np.percentile(values, 50):>10.3f}"
+              f"{np.percentile(values, 99):>10.3f}{values.max():>10.3f}")
+    print()
+    print(f"Throughput: {args.runs / elapsed:.3f} digests/s, {http_requests / elapsed:.1f} upstream HTTP requests/s")
+    print(f"Emails sent: {stats.get('smtp.messages', 0)} ({stats.get('smtp.bytes', 0) / 1024:.0f} KiB)  "
+          f"errors injected: http={stats.get('http.errors', 0)} imap={stats.get('imap.errors', 0)} "
+          f"smtp={stats.get('smtp.errors', 0)}")
+    print("Upstream requests: " + ", ".join(f"{key[5:]}={value}" for key, value in sorted(stats.items())
+                                            if key.startswith("http.") and key != "http.errors"))
+    print(f"Peak RSS (digest process): {peak_rss_mb:.1f} MiB")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="number of digest runs")
+    parser.add_argument("--feeds", type=int, default=50, help="number of RSS feeds")
+    parser.add_argument("--tickers", type=int, default=20, help="number of Finnhub symbols")
+    parser.add_argument("--subreddits", type=int, default=10, help="number of Reddit feeds")
+    parser.add_argument("--locations", type=int, default=3, help="number of weather locations")
+    parser.add_argument("--recipients", type=int, default=5, help="number of email recipients")
+    parser.add_argument("--items", type=int, default=25, help="entries per RSS feed")
+    parser.add_argument("--text-size", type=int, default=500, help="characters of text per item")
+    parser.add_argument("--latency", type=float, default=0.02, help="mean upstream latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of HTTP, IMAP and SMTP requests that fail")
+    parser.add_argument("--nws-max-age", type=int, default=0, help="Cache-Control max-age for NWS forecasts")
+    parser.add_argument("--gemini-stories", type=int, default=5, help="stories in each Gemini response")
+    parser.add_argument("--gemini-summary-size", type=int, default=120,
+                        help="characters of summary per story in Gemini responses")
+    parser.add_argument("--hourly", action="store_true", help="also fetch hourly forecasts")
+    parser.add_argument("--structured", action="store_true", help="use Gemini structured-output mode")
+    parser.add_argument("--no-feedback", action="store_true", help="IMAP inbox has no feedback reply")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the stand-ins")
+    parser.add_argument("--log-level", default="WARNING", help="digest log level during the test")
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    settings = {
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "items": args.items,
+        "text_size": args.text_size,
+        "nws_max_age": args.nws_max_age,
+        "gemini_stories": args.gemini_stories,
+        "gemini_summary_size": args.gemini_summary_size,
+        "feedback": not args.no_feedback,
+        "seed": args.seed,
+    }
+    process, ports = start_stand_ins(settings)
+
+    # main.py writes its logs to the working directory on import, so import it from a scratch directory.
+    workdir = tempfile.mkdtemp(prefix="digest-loadtest-")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    import main
+    logging.getLogger().setLevel(args.log_level)
+
+    configure_digest(main, args, ports, workdir)
+    fan_out_send(main, [f"reader{i}@example.com" for i in range(args.recipients)])
+    timings = {}
+    instrument(main, timings)
+
+    start = time.perf_counter()
+    for run_number in range(args.runs):
+        print(f"Run {run_number + 1}/{args.runs}...", flush=True)
+        main.main()
+    elapsed = time.perf_counter() - start
+
+    print_report(args, timings, elapsed, fetch_stats(ports))
+    print(f"Scratch files and logs: {workdir}")
+    process.terminate()
+
+
+if __name__ == "__main__":
+    run()
@@ -6,27 +6,124 @@ import time
 import logging
 import json
 import os
+import io
+import html
+import importlib
+import atexit
+import copy
+import queue
+import uuid
+import threading
+import re
+import sqlite3
+import numpy as np
+from abc import ABC, abstractmethod
+from contextlib import closing
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor, wait
 from bs4 import BeautifulSoup
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email import message_from_bytes
 from email.header import decode_header
+from email.utils import parsedate_to_datetime
 from datetime import datetime, timezone, timedelta
-from urllib.parse import quote
+from urllib.parse import quote, urlparse, parse_qs
+from string import Formatter
 
 # --- Set up Logging (Dual-Output Version) ---
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler('digest.log', mode='w')
-file_handler.setLevel(logging.DEBUG)
-file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
-stream_handler = logging.StreamHandler()
-stream_handler.setLevel(logging.INFO)
-stream_formatter = logging.Formatter('%(message)s')
-stream_handler.setFormatter(stream_formatter)
-logger.addHandler(stream_handler)
+# Records are handed to a queue and written by a background listener thread, so
+# file I/O never blocks the fetch threads. digest.log rotates by size and keeps
+# several weeks of runs; digest.jsonl holds the same records as JSON lines. Every
+# record carries the run ID so one run's lines can be picked out of the history.
+LOG_FILE = 'digest.log'
+JSON_LOG_FILE = 'digest.jsonl'
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 10
+RUN_ID = uuid.uuid4().hex[:12]
+
+
+def new_run_id():
+    """Starts a new correlation ID for the records logged by the next run."""
+    global RUN_ID
+    RUN_ID = uuid.uuid4().hex[:12]
+    return RUN_ID
+
+
+class RunIdFilter(logging.Filter):
+    """Tags each record with the current run's correlation ID."""
+
+    def filter(self, record):
+        record.run_id = RUN_ID
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single JSON line."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "run_id": getattr(record, 'run_id', None),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "function": record.funcName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class StructuredQueueHandler(QueueHandler):
+    """QueueHandler that keeps a record's traceback separate from its message.
+
+    The stock prepare() folds the traceback into the message, which would leave the
+    JSON log without an "exception" field."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        # With exc_info still set, the stock handling would fold the traceback into the
+        # message; the JSON formatter reads the separate exc_text instead.
+        record.exc_info = None
+        return record
+
+
+def setup_logging():
+    """Routes the root logger through a queue to rotating file and console handlers."""
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    file_handler.setLevel(logging.DEBUG)
+    file_formatter = logging.Formatter('%(asctime)s - %(run_id)s - %(levelname)s - %(message)s')
+    file_handler.setFormatter(file_formatter)
+    json_handler = RotatingFileHandler(JSON_LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    json_handler.setLevel(logging.DEBUG)
+    json_handler.setFormatter(JsonFormatter())
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.INFO)
+    stream_formatter = logging.Formatter('%(message)s')
+    stream_handler.setFormatter(stream_formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(RunIdFilter())
+    listener = QueueListener(log_queue, file_handler, json_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(queue_handler)
+    return listener
+
+
+setup_logging()
 
 
 # --- Import settings from config.py ---
@@ -39,9 +136,39 @@ except ImportError:
 # Define a single, descriptive User-Agent for all requests.
 USER_AGENT = "DailyDigestBot/1.0"
 
+# Upstream endpoints (overridden by loadtest.py to point at local stand-in servers).
+FINNHUB_API_URL = "https://finnhub.io/api/v1"
+NWS_API_URL = "https://api.weather.gov"
+WIKIPEDIA_URL = "https://en.wikipedia.org"
+XKCD_FEED_URL = "https://xkcd.com/atom.xml"
+NASA_FEED_URL = "https://www.nasa.gov/feeds/iotd-feed/"
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta"
+
 # Path to feedback context file (same directory as script)
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 FEEDBACK_CONTEXT_FILE = os.path.join(SCRIPT_DIR, "feedback_context.md")
+SOURCE_CACHE_FILE = os.path.join(SCRIPT_DIR, "source_cache.json")
+MARKET_HISTORY_DB = os.path.join(SCRIPT_DIR, "market_history.db")
+WEATHER_CACHE_FILE = os.path.join(SCRIPT_DIR, "weather_cache.json")
+LLM_USAGE_FILE = os.path.join(SCRIPT_DIR, "llm_usage.json")
+
+# Gemini models in order of preference, with their requests-per-minute, tokens-per-minute
+# and requests-per-day limits. Used when config.GEMINI_MODELS is not set.
+DEFAULT_GEMINI_MODELS = {
+    "gemini-2.5-flash": {"rpm": 10, "tpm": 250000, "rpd": 250},
+    "gemini-2.5-flash-lite": {"rpm": 15, "tpm": 250000, "rpd": 1000},
+}
+
+# Number of hourly forecast periods shown when NWS_INCLUDE_HOURLY is enabled.
+NWS_HOURLY_PERIODS = 12
+
+AI_SUMMARY_ERROR_HTML = "<h2>Error</h2><p>Could not generate AI summary. See digest.log for details.</p>"
+
+# Reddit returns at most 100 posts per listing request.
+REDDIT_MAX_LIMIT = 100
+
+# Digest sections in display order, used when config.DIGEST_SOURCES is not set.
+DEFAULT_SOURCES = ["financial", "weather", "nasa", "wikipedia", "reddit", "rss", "xkcd"]
 
 
 def estimate_tokens(text):
@@ -83,7 +210,8 @@ def check_for_feedback():
     
     try:
         # Connect to IMAP server
-        mail = imaplib.IMAP4_SSL(config.IMAP_SERVER, config.IMAP_PORT)
+        # A timeout keeps a hung server from stalling the AI summary, which waits on this.
+        mail = imaplib.IMAP4_SSL(config.IMAP_SERVER, config.IMAP_PORT, timeout=getattr(config, 'IMAP_TIMEOUT', 30))
         mail.login(config.EMAIL_SENDER, config.EMAIL_PASSWORD)
         mail.select('INBOX')
         
@@ -161,11 +289,6 @@ def process_and_update_feedback(new_feedback):
     existing_context = load_feedback_context()
     
     # Use Gemini to consolidate and summarize feedback
-    api_key = config.GEMINI_API_KEY
-    model_name = "gemini-2.5-flash"
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
-    headers = {'Content-Type': 'application/json'}
-    
     prompt = f"""You are helping manage a user's personalized news digest preferences.
 
 EXISTING PREFERENCES:
@@ -198,16 +321,8 @@ Last updated: {datetime.now().strftime('%Y-%m-%d')}
 
 IMPORTANT: Keep the entire output under 750 words to stay within token limits. Be concise but preserve all important preferences."""
 
-    body = {
-        "contents": [{"parts": [{"text": prompt}]}]
-    }
-    
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(body))
-        response.raise_for_status()
-        
-        response_data = response.json()
-        updated_context = response_data['candidates'][0]['content']['parts'][0]['text']
+        updated_context = gemini_generate(prompt)
         
         # Verify token count and truncate if needed
         tokens = estimate_tokens(updated_context)
@@ -217,11 +332,7 @@ IMPORTANT: Keep the entire output under 750 words to stay within token limits. B
             condense_prompt = f"""Please condense this text to under 600 words while preserving all key preferences:
 
 {updated_context}"""
-            body = {"contents": [{"parts": [{"text": condense_prompt}]}]}
-            response = requests.post(url, headers=headers, data=json.dumps(body))
-            response.raise_for_status()
-            response_data = response.json()
-            updated_context = response_data['candidates'][0]['content']['parts'][0]['text']
+            updated_context = gemini_generate(condense_prompt)
         
         save_feedback_context(updated_context)
         logging.info("Feedback context updated successfully.")
@@ -236,43 +347,149 @@ IMPORTANT: Keep the entire output under 750 words to stay within token limits. B
 
 
 
-def get_financial_data(api_key, assets):
-    """Fetches financial data from the Finnhub API."""
+def refresh_feedback_context():
+    """Checks for new feedback, folds it into the stored context, and returns the current context."""
+    try:
+        feedback = check_for_feedback()
+        if feedback:
+            logging.info("Processing user feedback...")
+            return process_and_update_feedback(feedback)
+    except Exception:
+        logging.exception("Error refreshing feedback context")
+    return load_feedback_context()
+
+
+def fetch_financial_quotes(api_key, assets):
+    """Fetches a quote snapshot for each asset from the Finnhub API."""
     if not api_key or not assets:
-        return ""
+        return []
     
     logging.info("Fetching financial data...")
-    html = "<h1>Market Report</h1>"
+    quotes = []
     
     for name, symbol in assets.items():
         try:
-            url = f"https://finnhub.io/api/v1/quote?symbol={symbol}&token={api_key}"
+            url = f"{FINNHUB_API_URL}/quote?symbol={symbol}&token={api_key}"
             response = requests.get(url)
             response.raise_for_status()
             data = response.json()
             
-            price = data.get('c', 0)
-            change = data.get('d', 0)
-            pct_change = data.get('dp', 0)
-            
-            color = "green" if change >= 0 else "red"
-            sign = "+" if change >= 0 else ""
-
-            html += f"""
-                <p>
-                    <b>{name}:</b> ${price:,.2f} 
-                    <span style="color:{color};">({sign}{change:,.2f} / {sign}{pct_change:.2f}%)</span>
-                </p>
-            """
+            quotes.append({
+                "name": name,
+                "symbol": symbol,
+                "price": data.get('c', 0),
+                "change": data.get('d', 0),
+                "pct_change": data.get('dp', 0),
+            })
         except Exception:
             logging.exception(f"Could not fetch data for financial asset: {name}")
 
-    return html + "<hr>"
+    return quotes
 
-def get_weather_forecast(url):
-    """Fetches the weather forecast from the National Weather Service (NWS) API."""
-    if not url:
+def get_financial_data(api_key, assets):
+    """Fetches financial data from the Finnhub API."""
+    if not api_key or not assets:
         return ""
+    return render_to_string(render_financial_section, fetch_financial_quotes(api_key, assets))
+
+def _open_market_history():
+    """Opens the market history database, creating the quotes table if it is missing."""
+    conn = sqlite3.connect(MARKET_HISTORY_DB)
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS quotes (symbol TEXT NOT NULL, ts REAL NOT NULL, price REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS quotes_symbol_ts ON quotes (symbol, ts)")
+    return conn
+
+def record_quotes(conn, quotes, timestamp):
+    """Appends this run's quotes to the market history database."""
+    rows = [(quote['symbol'], timestamp, quote['price']) for quote in quotes if quote['price'] > 0]
+    if not rows:
+        return
+    try:
+        with conn:
+            conn.executemany("INSERT INTO quotes (symbol, ts, price) VALUES (?, ?, ?)", rows)
+        logging.debug(f"Recorded {len(rows)} quotes in market history.")
+    except Exception:
+        logging.exception("Error recording market history")
+
+def load_price_history(conn, symbols, since):
+    """Loads the prices recorded since a timestamp for several symbols in one query.
+
+    Returns {symbol: (timestamps, prices)} arrays; symbols with no history get empty arrays."""
+    symbols = list(dict.fromkeys(symbols))
+    placeholders = ", ".join("?" * len(symbols))
+    rows = conn.execute(
+        f"SELECT symbol, ts, price FROM quotes WHERE symbol IN ({placeholders}) AND ts >= ? ORDER BY symbol, ts",
+        (*symbols, since),
+    ).fetchall()
+    samples = {symbol: [] for symbol in symbols}
+    for symbol, ts, price in rows:
+        samples[symbol].append((ts, price))
+    history = {}
+    for symbol, points in samples.items():
+        points = np.array(points, dtype=float).reshape(-1, 2)
+        history[symbol] = (points[:, 0], points[:, 1])
+    return history
+
+def _change_since(timestamps, prices, cutoff):
+    """Percent change from the last price at or before cutoff to the latest price."""
+    index = np.searchsorted(timestamps, cutoff, side='right') - 1
+    if index < 0 or prices[index] == 0:
+        return None
+    return float((prices[-1] / prices[index] - 1) * 100)
+
+def compute_market_stats(timestamps, prices, now):
+    """Computes 7/30-day change, moving averages and sparkline points from local history."""
+    if prices.size == 0:
+        return None
+    week_ago = now - 7 * 86400
+    month_ago = now - 30 * 86400
+    return {
+        "change_7d": _change_since(timestamps, prices, week_ago),
+        "change_30d": _change_since(timestamps, prices, month_ago),
+        "ma_7": float(prices[timestamps >= week_ago].mean()) if (timestamps >= week_ago).any() else None,
+        "ma_30": float(prices[timestamps >= month_ago].mean()) if (timestamps >= month_ago).any() else None,
+        "sparkline": prices[timestamps >= month_ago].tolist(),
+    }
+
+def add_market_history(quotes):
+    """Records the quotes, then attaches history stats computed from the local store."""
+    now = time.time()
+    try:
+        with closing(_open_market_history()) as conn:
+            record_quotes(conn, quotes, now)
+            # Look back one extra day so the 30-day change has a baseline sample.
+            history = load_price_history(conn, [asset['symbol'] for asset in quotes], now - 31 * 86400)
+    except Exception:
+        logging.exception("Could not load market history")
+        return quotes
+    for asset in quotes:
+        timestamps, prices = history[asset['symbol']]
+        asset['history'] = compute_market_stats(timestamps, prices, now)
+    return quotes
+
+def _nws_expiry(headers):
+    """Returns when an NWS response expires, from its Cache-Control or Expires header."""
+    match = re.search(r'max-age=(\d+)', headers.get('Cache-Control', ''))
+    if match:
+        return time.time() + int(match.group(1))
+    try:
+        return parsedate_to_datetime(headers.get('Expires', '')).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+def fetch_weather_periods(url, count=2, cache=None):
+    """Fetches the forecast periods from the National Weather Service (NWS) API.
+
+    If a cache dict is given, a response is reused until NWS says it expires."""
+    if not url:
+        return []
+    
+    if cache is not None:
+        cached = cache.get(url)
+        if cached and cached['expires'] > time.time():
+            logging.debug(f"Using cached NWS forecast for {url}")
+            return cached['periods'][:count]
     
     headers = {'User-Agent': USER_AGENT}
     
@@ -285,27 +502,106 @@ def get_weather_forecast(url):
         
         if not periods:
             logging.warning("Weather data received, but no forecast periods found.")
-            return ""
+            return []
 
         logging.debug(f"Found {len(periods)} weather periods.")
-        forecast_html = "<h1>Weather Report</h1>"
-        for period in periods[:2]:
-            forecast_html += f"""
-                <h3>{period['name']}</h3>
-                <p><b>{period['temperature']}°{period['temperatureUnit']}</b> - {period['shortForecast']}</p>
-                <p>{period['detailedForecast']}</p>
-            """
-        return forecast_html + "<hr>"
+        periods = [
+            {
+                "name": period['name'],
+                "startTime": period.get('startTime', ""),
+                "temperature": period['temperature'],
+                "temperatureUnit": period['temperatureUnit'],
+                "shortForecast": period['shortForecast'],
+                "detailedForecast": period['detailedForecast'],
+            }
+            for period in periods[:count]
+        ]
+        if cache is not None:
+            cache[url] = {"expires": _nws_expiry(response.headers), "periods": periods}
+        return periods
 
     except requests.exceptions.RequestException:
         logging.exception("Error fetching weather data")
+        return []
+
+def resolve_nws_gridpoint(lat, lon, points_cache):
+    """Looks up the forecast URLs for a location; gridpoints never move, so they are cached for good."""
+    key = f"{lat:.4f},{lon:.4f}"
+    if key not in points_cache:
+        logging.info(f"Resolving NWS gridpoint for {key}...")
+        response = requests.get(f"{NWS_API_URL}/points/{key}", headers={'User-Agent': USER_AGENT})
+        response.raise_for_status()
+        properties = response.json()['properties']
+        points_cache[key] = {
+            "forecast": properties['forecast'],
+            "forecastHourly": properties['forecastHourly'],
+        }
+    return points_cache[key]
+
+def load_weather_cache():
+    """Load cached NWS gridpoints and forecasts from disk."""
+    cache = {"points": {}, "forecasts": {}}
+    if not os.path.exists(WEATHER_CACHE_FILE):
+        return cache
+    try:
+        with open(WEATHER_CACHE_FILE, 'r') as f:
+            cache.update(json.load(f))
+    except Exception:
+        logging.exception("Error reading weather cache file")
+    return cache
+
+def save_weather_cache(cache):
+    """Save the weather cache to disk, dropping forecasts that have expired."""
+    now = time.time()
+    cache["forecasts"] = {url: entry for url, entry in cache["forecasts"].items() if entry['expires'] > now}
+    try:
+        with open(WEATHER_CACHE_FILE, 'w') as f:
+            json.dump(cache, f)
+    except Exception:
+        logging.exception("Error saving weather cache file")
+
+def fetch_location_weather(location, cache, include_hourly=False):
+    """Fetches the forecast (and optionally the hourly forecast) for one location.
+
+    A location has a "name" and either "lat"/"lon" or a "forecast_url"."""
+    try:
+        if location.get('forecast_url'):
+            urls = {"forecast": location['forecast_url']}
+        else:
+            urls = resolve_nws_gridpoint(location['lat'], location['lon'], cache["points"])
+        weather = {
+            "name": location.get('name', ""),
+            "periods": fetch_weather_periods(urls['forecast'], 2, cache["forecasts"]),
+        }
+        if include_hourly and urls.get('forecastHourly'):
+            weather["hourly"] = fetch_weather_periods(urls['forecastHourly'], NWS_HOURLY_PERIODS, cache["forecasts"])
+        return weather
+    except Exception:
+        logging.exception(f"Could not fetch weather for location: {location}")
+        return None
+
+def get_weather_forecasts(locations, include_hourly=False):
+    """Fetches forecasts for all locations in parallel, reusing cached gridpoints and forecasts."""
+    if not locations:
+        return []
+    cache = load_weather_cache()
+    with ThreadPoolExecutor(max_workers=min(len(locations), 8)) as executor:
+        forecasts = list(executor.map(lambda location: fetch_location_weather(location, cache, include_hourly), locations))
+    save_weather_cache(cache)
+    return [forecast for forecast in forecasts if forecast and forecast['periods']]
+
+def get_weather_forecast(url):
+    """Fetches the weather forecast from the National Weather Service (NWS) API."""
+    periods = fetch_weather_periods(url)
+    if not periods:
         return ""
+    return render_to_string(render_weather_section, [{"name": "", "periods": periods}])
 
 def fetch_summary_via_api(title):
     """Fetches Wikipedia article details using the REST API."""
     logging.debug(f"Fetching Wikipedia API summary for: {title}")
     encoded_title = quote(title, safe='')
-    url = f"https://en.wikipedia.org/api/rest_v1/page/summary/{encoded_title}"
+    url = f"{WIKIPEDIA_URL}/api/rest_v1/page/summary/{encoded_title}"
     headers = {'User-Agent': USER_AGENT}
     
     try:
@@ -324,7 +620,7 @@ def get_wikipedia_article_of_the_day():
     """Fetches Wikipedia's featured article by scraping the main page, then using the API."""
     logging.info("Fetching Wikipedia Article of the Day...")
     try:
-        main_page_url = "https://en.wikipedia.org/wiki/Main_Page"
+        main_page_url = f"{WIKIPEDIA_URL}/wiki/Main_Page"
         headers = {'User-Agent': USER_AGENT}
         response = requests.get(main_page_url, headers=headers)
         response.raise_for_status()
@@ -333,7 +629,7 @@ def get_wikipedia_article_of_the_day():
         tfa_div = soup.find('div', id='mp-tfa')
         article_link_tag = tfa_div.find('b').find('a')
         article_title = article_link_tag.get_text()
-        article_url = f"https://en.wikipedia.org{article_link_tag['href']}"
+        article_url = f"{WIKIPEDIA_URL}{article_link_tag['href']}"
         
         api_data = fetch_summary_via_api(article_title)
         
@@ -354,7 +650,7 @@ def get_wikipedia_article_of_the_day():
 def get_latest_xkcd():
     """Fetches the latest comic from xkcd if it's new."""
     logging.info("Fetching latest xkcd comic...")
-    url = "https://xkcd.com/atom.xml"
+    url = XKCD_FEED_URL
     feed = feedparser.parse(url, agent=USER_AGENT)
     
     if feed.status != 200 or not feed.entries:
@@ -387,7 +683,7 @@ def get_latest_xkcd():
 def get_nasa_image_of_the_day():
     """Fetches the latest image and description from the NASA IOTD feed."""
     logging.info("Fetching NASA Image of the Day...")
-    url = "https://www.nasa.gov/feeds/iotd-feed/"
+    url = NASA_FEED_URL
     
     feed = feedparser.parse(url, agent=USER_AGENT)
     if feed.status != 200 or not feed.entries:
@@ -400,40 +696,130 @@ def get_nasa_image_of_the_day():
         return None
     return {"title": latest_item.title, "description": latest_item.description, "image_url": image_url}
 
-def get_reddit_json_content(feeds):
-    """Fetches headlines and identifies post type (text vs. link/image) from Reddit."""
-    all_content = ""
-    headers = {'User-Agent': USER_AGENT}
+def parse_reddit_feed_url(url):
+    """Splits a Reddit listing URL into (base URL, subreddit, sort, time window), or returns None."""
+    parsed = urlparse(url)
+    parts = [part for part in parsed.path.split('/') if part]
+    if not parsed.netloc or len(parts) not in (3, 4) or parts[0] != 'r' or parts[-1] != '.json':
+        return None
+    sort = parts[2] if len(parts) == 4 else ""
+    time_window = parse_qs(parsed.query).get('t', [""])[0]
+    return f"{parsed.scheme}://{parsed.netloc}", parts[1], sort, time_window
+
+def _extract_reddit_posts(listing):
+    """Keeps only the fields the digest uses from a Reddit listing."""
+    posts = []
+    for post in listing['data']['children']:
+        post_data = post['data']
+        
+        if post_data.get('is_self', False):
+            post_type = "Text Post"
+            body = post_data.get('selftext', '')
+        else:
+            post_type = "Link/Image Post"
+            body = "No summary available."
+        
+        posts.append({
+            "subreddit": post_data.get('subreddit', ""),
+            "title": post_data['title'],
+            "link": f"https://www.reddit.com{post_data['permalink']}",
+            "type": post_type,
+            "content": body,
+        })
+    return posts
+
+def _reddit_listing_url(base_url, subreddits, sort, time_window):
+    url = f"{base_url}/r/{'+'.join(subreddits)}/{sort + '/' if sort else ''}.json"
+    if time_window:
+        url += f"?t={time_window}"
+    return url
+
+def _get_reddit_listing(url, limit):
+    response = requests.get(url, headers={'User-Agent': USER_AGENT}, params={'limit': limit})
+    response.raise_for_status()
+    return _extract_reddit_posts(response.json())
+
+def _fetch_multireddit(base_url, subreddits, sort, time_window, per_feed):
+    """Fetches several subreddits with one r/a+b+c request and splits the posts back by subreddit.
+
+    Subreddits that could not be fetched at all are left out of the result."""
+    limit = min(REDDIT_MAX_LIMIT, per_feed * len(subreddits))
+    url = _reddit_listing_url(base_url, subreddits, sort, time_window)
+    logging.info(f"Fetching JSON for r/{'+'.join(subreddits)}...")
+    try:
+        posts = _get_reddit_listing(url, limit)
+    except Exception:
+        # Don't let one failed combined request take down every subreddit in it.
+        logging.exception(f"Error fetching JSON from {url}; fetching each subreddit on its own.")
+        by_subreddit = {}
+        for subreddit in subreddits:
+            single_url = _reddit_listing_url(base_url, [subreddit], sort, time_window)
+            try:
+                by_subreddit[subreddit.lower()] = _get_reddit_listing(single_url, per_feed)[:per_feed]
+            except Exception:
+                logging.exception(f"Error fetching JSON from {single_url}")
+        return by_subreddit
+    logging.debug(f"Found {len(posts)} posts for {len(subreddits)} subreddits.")
+
+    by_subreddit = {subreddit.lower(): [] for subreddit in subreddits}
+    for post in posts:
+        bucket = by_subreddit.get(post['subreddit'].lower())
+        if bucket is not None and len(bucket) < per_feed:
+            bucket.append(post)
+
+    # A full listing may have been crowded out by busier subreddits; fetch those on their own.
+    if len(posts) >= limit:
+        for subreddit in subreddits:
+            if len(by_subreddit[subreddit.lower()]) < per_feed:
+                single_url = _reddit_listing_url(base_url, [subreddit], sort, time_window)
+                try:
+                    by_subreddit[subreddit.lower()] = _get_reddit_listing(single_url, per_feed)[:per_feed]
+                except Exception:
+                    # Keep whatever the combined listing gave us for this subreddit.
+                    logging.exception(f"Error fetching JSON from {single_url}")
+    return by_subreddit
+
+def fetch_reddit_posts(feeds, per_feed=5):
+    """Fetches headlines and identifies post type (text vs. link/image) from Reddit.
+
+    Feeds that share a sort and time window are combined into multi-subreddit requests,
+    and only as many posts as the digest uses are requested."""
+    groups = {}
+    posts_by_category = {}
     for category, url in feeds.items():
+        parsed = parse_reddit_feed_url(url)
+        if parsed:
+            base_url, subreddit, sort, time_window = parsed
+            group = groups.setdefault((base_url, sort, time_window), {})
+            group.setdefault(subreddit.lower(), (subreddit, []))[1].append(category)
+            continue
         logging.info(f"Fetching JSON for {category}...")
         try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-            all_content += f"<h2>{category}</h2>\n"
-            posts = data['data']['children']
-            logging.debug(f"Found {len(posts)} posts in {category} feed.")
-            for post in posts[:5]:
-                post_data = post['data']
-                title = post_data['title']
-                link = f"https://www.reddit.com{post_data['permalink']}"
-                
-                if post_data.get('is_self', False):
-                    post_type = "Text Post"
-                    body = post_data.get('selftext', '')
-                else:
-                    post_type = "Link/Image Post"
-                    body = "No summary available."
-                
-                all_content += f"- Title: {title} ({link})\n  Type: {post_type}\n  Content: {body}\n"
-            all_content += "\n"
+            posts_by_category[category] = _get_reddit_listing(url, per_feed)[:per_feed]
+            logging.debug(f"Found {len(posts_by_category[category])} posts in {category} feed.")
         except Exception:
             logging.exception(f"Error fetching JSON from {url}")
-    return all_content
 
-def get_rss_content(feeds):
+    chunk_size = max(1, REDDIT_MAX_LIMIT // per_feed)
+    for (base_url, sort, time_window), subreddits in groups.items():
+        entries = list(subreddits.values())
+        for start in range(0, len(entries), chunk_size):
+            chunk = entries[start:start + chunk_size]
+            by_subreddit = _fetch_multireddit(base_url, [name for name, _ in chunk], sort, time_window, per_feed)
+            for name, categories in chunk:
+                if name.lower() not in by_subreddit:
+                    continue
+                for category in categories:
+                    posts_by_category[category] = by_subreddit[name.lower()]
+
+    return [
+        {"category": category, "items": posts_by_category[category]}
+        for category in feeds if category in posts_by_category
+    ]
+
+def fetch_rss_entries(feeds):
     """Fetches headlines and summaries/descriptions from a dictionary of standard RSS feeds."""
-    all_content = ""
+    sections = []
     for category, url in feeds.items():
         logging.info(f"Fetching RSS feed for {category}...")
         feed = feedparser.parse(url, agent=USER_AGENT)
@@ -441,36 +827,729 @@ def get_rss_content(feeds):
             logging.warning(f"Error fetching RSS feed {url}. Status: {feed.status}")
             continue
         logging.debug(f"Found {len(feed.entries)} entries in {category} feed.")
-        all_content += f"<h2>{category}</h2>\n"
+        items = []
         for entry in feed.entries[:5]:
-            title = entry.title
-            link = entry.link
-            content_blurb = entry.get('summary', entry.get('description', ''))
-            all_content += f"- Title: {title} ({link})\n  Content: {content_blurb}\n"
+            items.append({
+                "title": entry.title,
+                "link": entry.link,
+                "content": entry.get('summary', entry.get('description', '')),
+            })
+        sections.append({"category": category, "items": items})
+    return sections
+
+def format_news_for_ai(sections):
+    """Formats fetched news sections as the plain-text listing sent to Gemini."""
+    all_content = ""
+    for section in sections:
+        all_content += f"<h2>{section['category']}</h2>\n"
+        for item in section['items']:
+            all_content += f"- Title: {item['title']} ({item['link']})\n"
+            if item.get('type'):
+                all_content += f"  Type: {item['type']}\n"
+            all_content += f"  Content: {item['content']}\n"
         all_content += "\n"
     return all_content
 
-def get_ai_summary(content_to_summarize, feedback_context=""):
-    """Sends content to Gemini AI for summarization using a direct requests call.
-    Usees the REST API endpoint to interact with the Gemini model. 
-    Not using the Google client library due to issues getting that working on some hardware."""
-    logging.info("Sending content to Gemini for summarization via requests...")
-    
+def get_reddit_json_content(feeds):
+    """Fetches Reddit headlines formatted for the AI summary."""
+    return format_news_for_ai(fetch_reddit_posts(feeds))
+
+def get_rss_content(feeds):
+    """Fetches RSS headlines formatted for the AI summary."""
+    return format_news_for_ai(fetch_rss_entries(feeds))
+
+# --- Rendering ---
+# Templates are parsed once at import into literal/field parts, so rendering is just
+# writing those parts into the output buffer. HTML templates escape every value
+# unless it is wrapped in Markup (trusted HTML, such as the AI summary).
+
+class Markup(str):
+    """A string of trusted HTML that DigestTemplate writes without escaping."""
+
+class DigestTemplate:
+    """A precompiled template using str.format-style {field} placeholders."""
+
+    def __init__(self, source, escape=True):
+        self.parts = []
+        for literal, field, spec, conversion in Formatter().parse(source):
+            if spec or conversion:
+                # Values are escaped as plain strings; format them before rendering instead.
+                raise ValueError(f"Template field {{{field}}} may not use a format spec or conversion")
+            self.parts.append((literal, field))
+        self.escape = escape
+
+    def render_to(self, out, **values):
+        for literal, field in self.parts:
+            out.write(literal)
+            if field is None:
+                continue
+            value = values[field]
+            if self.escape and not isinstance(value, Markup):
+                value = html.escape(str(value))
+            out.write(str(value))
+
+FINANCIAL_HEADER_HTML = DigestTemplate("<h1>Market Report</h1>")
+FINANCIAL_ROW_HTML = DigestTemplate("""
+            <p>
+                <b>{name}:</b> ${price} 
+                <span style="color:{color};">({sign}{change} / {sign}{pct_change}%)</span>
+            </p>
+        """)
+FINANCIAL_ROW_TEXT = DigestTemplate("{name}: ${price} ({sign}{change} / {sign}{pct_change}%)\n", escape=False)
+FINANCIAL_TREND_HTML = DigestTemplate("""
+            <p style="font-size:smaller; color:#555;">
+                {sparkline} 7d: {change_7d} · 30d: {change_30d} · 7d avg: ${ma_7} · 30d avg: ${ma_30}
+            </p>
+        """)
+FINANCIAL_TREND_TEXT = DigestTemplate("  7d: {change_7d}  30d: {change_30d}  7d avg: ${ma_7}  30d avg: ${ma_30}\n", escape=False)
+
+WEATHER_HEADER_HTML = DigestTemplate("<h1>Weather Report</h1>")
+WEATHER_PERIOD_HTML = DigestTemplate("""
+            <h3>{name}</h3>
+            <p><b>{temperature}°{unit}</b> - {short}</p>
+            <p>{detailed}</p>
+        """)
+WEATHER_PERIOD_TEXT = DigestTemplate("{name}: {temperature}°{unit} - {short}\n{detailed}\n", escape=False)
+WEATHER_LOCATION_HTML = DigestTemplate("<h2>{name}</h2>")
+WEATHER_HOUR_HTML = DigestTemplate("""
+            <tr style="font-size:smaller;"><td>{time}</td><td>{temperature}°{unit}</td><td>{short}</td></tr>""")
+WEATHER_HOUR_TEXT = DigestTemplate("  {time}: {temperature}°{unit} - {short}\n", escape=False)
+
+NASA_HTML = DigestTemplate("""
+            <h1>Image of the Day: {title}</h1>
+            <p><img src="{image_url}" alt="{title}" style="max-width:100%; height:auto;" /></p>
+            <p>{description}</p>
+        """)
+NASA_TEXT = DigestTemplate("IMAGE OF THE DAY: {title}\n{image_url}\n{description}\n\n", escape=False)
+
+WIKIPEDIA_HTML = DigestTemplate("""
+            <hr><h1>Wikipedia Article of the Day</h1>
+            <h2><a href="{url}">{title}</a></h2>
+        """)
+WIKIPEDIA_IMAGE_HTML = DigestTemplate("""
+                <p><img src="{image_url}" alt="{title}" style="max-width:100%; height:auto;" /></p>
+            """)
+WIKIPEDIA_INTRO_HTML = DigestTemplate("<p>{intro}</p>")
+WIKIPEDIA_TEXT = DigestTemplate("WIKIPEDIA ARTICLE OF THE DAY: {title}\n{url}\n{intro}\n\n", escape=False)
+
+NEWS_CATEGORY_HTML = DigestTemplate("<h2>{name}</h2><ul>")
+NEWS_STORY_HTML = DigestTemplate('<li><a href="{link}">{title}</a>')
+NEWS_SUMMARY_HTML = DigestTemplate('<p style="font-size:smaller;"><i>{summary}</i></p>')
+NEWS_DIGEST_HTML = DigestTemplate("<hr><h1>Your News Digest</h1>{body}")
+NEWS_DIGEST_TEXT = DigestTemplate("YOUR NEWS DIGEST\n\n{body}\n\n", escape=False)
+
+XKCD_HTML = DigestTemplate("""
+            <hr>
+            <h1>Daily Comic: xkcd</h1>
+            <h2>{title}</h2>
+            <p><img src="{image_url}" alt="{title}" style="max-width:100%; height:auto;" /></p>
+            <p><i>{alt_text}</i></p>
+        """)
+XKCD_TEXT = DigestTemplate("DAILY COMIC: xkcd - {title}\n{image_url}\n{alt_text}\n\n", escape=False)
+
+def html_to_text(html_content):
+    """Converts an HTML fragment to plain text, one block element per line."""
+    return BeautifulSoup(html_content, 'html.parser').get_text("\n", strip=True)
+
+def render_to_string(render, data):
+    """Runs a section renderer against a fresh buffer and returns the result."""
+    out = io.StringIO()
+    render(data, out)
+    return out.getvalue()
+
+def _format_quote(quote):
+    change = quote['change']
+    sign = "+" if change >= 0 else ""
+    return {
+        "name": quote['name'],
+        "price": f"{quote['price']:,.2f}",
+        "color": "green" if change >= 0 else "red",
+        "sign": sign,
+        "change": f"{change:,.2f}",
+        "pct_change": f"{quote['pct_change']:.2f}",
+    }
+
+def render_sparkline(prices, width=120, height=24):
+    """Renders a price series as an inline SVG sparkline."""
+    values = np.asarray(prices, dtype=float)
+    if values.size < 2:
+        return Markup("")
+    low, high = values.min(), values.max()
+    xs = np.linspace(0, width, values.size)
+    ys = height - (values - low) / ((high - low) or 1.0) * height
+    points = " ".join(f"{x:.1f},{y:.1f}" for x, y in zip(xs, ys))
+    color = "green" if values[-1] >= values[0] else "red"
+    return Markup(
+        f'<svg width="{width}" height="{height}" viewBox="0 0 {width} {height}" style="vertical-align:middle;">'
+        f'<polyline fill="none" stroke="{color}" stroke-width="1.5" points="{points}" /></svg>'
+    )
+
+def _format_trend(history):
+    def pct(value):
+        return "n/a" if value is None else f"{value:+.2f}%"
+
+    def money(value):
+        return "n/a" if value is None else f"{value:,.2f}"
+
+    return {
+        "sparkline": render_sparkline(history['sparkline']),
+        "change_7d": pct(history['change_7d']),
+        "change_30d": pct(history['change_30d']),
+        "ma_7": money(history['ma_7']),
+        "ma_30": money(history['ma_30']),
+    }
+
+def render_financial_section(quotes, out):
+    """Renders the Market Report section from fetched quotes."""
+    FINANCIAL_HEADER_HTML.render_to(out)
+    for asset in quotes:
+        FINANCIAL_ROW_HTML.render_to(out, **_format_quote(asset))
+        if asset.get('history'):
+            FINANCIAL_TREND_HTML.render_to(out, **_format_trend(asset['history']))
+    out.write("<hr>")
+
+def render_financial_text(quotes, out):
+    out.write("MARKET REPORT\n")
+    for asset in quotes:
+        FINANCIAL_ROW_TEXT.render_to(out, **_format_quote(asset))
+        if asset.get('history'):
+            FINANCIAL_TREND_TEXT.render_to(out, **_format_trend(asset['history']))
+    out.write("\n")
+
+def _format_period(period):
+    return {
+        "name": period['name'],
+        "temperature": period['temperature'],
+        "unit": period['temperatureUnit'],
+        "short": period['shortForecast'],
+        "detailed": period['detailedForecast'],
+    }
+
+def _format_hour(period):
+    try:
+        start = datetime.fromisoformat(period['startTime']).strftime("%I %p").lstrip("0")
+    except ValueError:
+        start = period['startTime']
+    return {"time": start, **_format_period(period)}
+
+def render_weather_section(locations, out):
+    """Renders the Weather Report section from per-location forecasts."""
+    WEATHER_HEADER_HTML.render_to(out)
+    for location in locations:
+        if location['name']:
+            WEATHER_LOCATION_HTML.render_to(out, name=location['name'])
+        for period in location['periods']:
+            WEATHER_PERIOD_HTML.render_to(out, **_format_period(period))
+        if location.get('hourly'):
+            out.write("<table>")
+            for period in location['hourly']:
+                WEATHER_HOUR_HTML.render_to(out, **_format_hour(period))
+            out.write("</table>")
+    out.write("<hr>")
+
+def render_weather_text(locations, out):
+    out.write("WEATHER REPORT\n")
+    for location in locations:
+        if location['name']:
+            out.write(f"{location['name']}\n")
+        for period in location['periods']:
+            WEATHER_PERIOD_TEXT.render_to(out, **_format_period(period))
+        for period in location.get('hourly', []):
+            WEATHER_HOUR_TEXT.render_to(out, **_format_hour(period))
+    out.write("\n")
+
+def render_nasa_section(nasa_data, out):
+    """Renders the NASA Image of the Day section."""
+    # The feed description may contain markup; show it as plain text.
+    NASA_HTML.render_to(out, title=nasa_data['title'], image_url=nasa_data['image_url'],
+                        description=html_to_text(nasa_data['description']))
+
+def render_nasa_text(nasa_data, out):
+    NASA_TEXT.render_to(out, title=nasa_data['title'], image_url=nasa_data['image_url'],
+                        description=html_to_text(nasa_data['description']))
+
+def render_wikipedia_section(wiki_data, out):
+    """Renders the Wikipedia Article of the Day section."""
+    WIKIPEDIA_HTML.render_to(out, url=wiki_data['url'], title=wiki_data['title'])
+    if wiki_data.get('image_url'):
+        WIKIPEDIA_IMAGE_HTML.render_to(out, image_url=wiki_data['image_url'], title=wiki_data['title'])
+    WIKIPEDIA_INTRO_HTML.render_to(out, intro=wiki_data['intro'])
+
+def render_wikipedia_text(wiki_data, out):
+    WIKIPEDIA_TEXT.render_to(out, title=wiki_data['title'], url=wiki_data['url'], intro=wiki_data['intro'])
+
+def render_xkcd_section(xkcd_data, out):
+    """Renders the xkcd Daily Comic section."""
+    XKCD_HTML.render_to(out, **xkcd_data)
+
+def render_xkcd_text(xkcd_data, out):
+    XKCD_TEXT.render_to(out, **xkcd_data)
+
+def render_digest(sources, results, ai_html_body):
+    """Renders the email body from fetched source results.
+
+    Returns the HTML body and its plain-text alternative. The AI news digest takes
+    the place of the first summarized source."""
+    html_out = io.StringIO()
+    text_out = io.StringIO()
+    news_placed = False
+    for source in sources:
+        if source.summarize:
+            if ai_html_body and not news_placed:
+                NEWS_DIGEST_HTML.render_to(html_out, body=Markup(ai_html_body))
+                NEWS_DIGEST_TEXT.render_to(text_out, body=html_to_text(ai_html_body))
+                news_placed = True
+            continue
+        data = results.get(source.name)
+        if data:
+            source.render(data, html_out)
+            source.render_text(data, text_out)
+    return html_out.getvalue(), text_out.getvalue()
+
+# --- Source plugins ---
+# Each digest section is a Source: fetch() returns a structured, JSON-serializable
+# result, render() writes its HTML fragment into the email buffer and render_text()
+# writes the plain-text equivalent. Sources marked `summarize` are not rendered
+# directly; they return news sections ([{"category", "items": [{"title", "link",
+# "content", optional "type"}]}]) that are summarized by Gemini instead.
+
+SOURCE_REGISTRY = {}
+
+def register_source(cls):
+    """Class decorator that makes a Source available by name in config.DIGEST_SOURCES."""
+    SOURCE_REGISTRY[cls.name] = cls
+    return cls
+
+class Source(ABC):
+    """Base class for digest sources."""
+    name = ""
+    summarize = False
+    cache_ttl = 0
+
+    def is_enabled(self):
+        return True
+
+    @abstractmethod
+    def fetch(self):
+        """Returns this source's data, or None if nothing could be fetched."""
+
+    def render(self, data, out):
+        pass
+
+    def render_text(self, data, out):
+        out.write(html_to_text(render_to_string(self.render, data)))
+        out.write("\n\n")
+
+    def prompt_text(self, data):
+        return format_news_for_ai(data) if self.summarize else ""
+
+@register_source
+class FinancialSource(Source):
+    name = "financial"
+
+    def is_enabled(self):
+        return bool(getattr(config, 'FINNHUB_API_KEY', "") and getattr(config, 'FINANCIAL_ASSETS', None))
+
+    def fetch(self):
+        quotes = fetch_financial_quotes(config.FINNHUB_API_KEY, config.FINANCIAL_ASSETS)
+        if getattr(config, 'MARKET_HISTORY_ENABLED', True):
+            add_market_history(quotes)
+        return quotes
+
+    def render(self, data, out):
+        render_financial_section(data, out)
+
+    def render_text(self, data, out):
+        render_financial_text(data, out)
+
+@register_source
+class WeatherSource(Source):
+    name = "weather"
+
+    def is_enabled(self):
+        return bool(getattr(config, 'WEATHER_LOCATIONS', None) or getattr(config, 'NWS_FORECAST_URL', ""))
+
+    def fetch(self):
+        locations = getattr(config, 'WEATHER_LOCATIONS', None) or [{"forecast_url": config.NWS_FORECAST_URL}]
+        return get_weather_forecasts(locations, getattr(config, 'NWS_INCLUDE_HOURLY', False))
+
+    def render(self, data, out):
+        render_weather_section(data, out)
+
+    def render_text(self, data, out):
+        render_weather_text(data, out)
+
+@register_source
+class NasaSource(Source):
+    name = "nasa"
+
+    def fetch(self):
+        return get_nasa_image_of_the_day()
+
+    def render(self, data, out):
+        render_nasa_section(data, out)
+
+    def render_text(self, data, out):
+        render_nasa_text(data, out)
+
+@register_source
+class WikipediaSource(Source):
+    name = "wikipedia"
+
+    def fetch(self):
+        return get_wikipedia_article_of_the_day()
+
+    def render(self, data, out):
+        render_wikipedia_section(data, out)
+
+    def render_text(self, data, out):
+        render_wikipedia_text(data, out)
+
+@register_source
+class XkcdSource(Source):
+    name = "xkcd"
+
+    def fetch(self):
+        return get_latest_xkcd()
+
+    def render(self, data, out):
+        render_xkcd_section(data, out)
+
+    def render_text(self, data, out):
+        render_xkcd_text(data, out)
+
+@register_source
+class RedditSource(Source):
+    name = "reddit"
+    summarize = True
+
+    def is_enabled(self):
+        return bool(getattr(config, 'REDDIT_JSON_FEEDS', None))
+
+    def fetch(self):
+        return fetch_reddit_posts(config.REDDIT_JSON_FEEDS)
+
+@register_source
+class RssSource(Source):
+    name = "rss"
+    summarize = True
+
+    def is_enabled(self):
+        return bool(getattr(config, 'GENERAL_RSS_FEEDS', None))
+
+    def fetch(self):
+        return fetch_rss_entries(config.GENERAL_RSS_FEEDS)
+
+def load_sources():
+    """Instantiates the sources listed in config.DIGEST_SOURCES, in display order.
+
+    Entries are either registered source names or "module.ClassName" paths to a Source subclass."""
+    sources = []
+    for entry in getattr(config, 'DIGEST_SOURCES', DEFAULT_SOURCES):
+        try:
+            if entry in SOURCE_REGISTRY:
+                source_cls = SOURCE_REGISTRY[entry]
+            else:
+                module_name, _, class_name = entry.rpartition('.')
+                source_cls = getattr(importlib.import_module(module_name), class_name)
+            source = source_cls()
+            if not source.name:
+                source.name = entry
+        except Exception:
+            logging.exception(f"Could not load digest source: {entry}")
+            continue
+        if source.is_enabled():
+            sources.append(source)
+        else:
+            logging.info(f"Source '{source.name}' is not configured. Skipping.")
+    return sources
+
+def load_source_cache():
+    """Load cached source results from disk."""
+    if not os.path.exists(SOURCE_CACHE_FILE):
+        return {}
+    try:
+        with open(SOURCE_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        logging.exception("Error reading source cache file")
+        return {}
+
+def save_source_cache(cache):
+    """Save cached source results to disk."""
+    try:
+        with open(SOURCE_CACHE_FILE, 'w') as f:
+            json.dump(cache, f)
+    except Exception:
+        logging.exception("Error saving source cache file")
+
+def _timed_fetch(source):
+    """Runs a source's fetch() and returns its result with the elapsed time."""
+    start = time.perf_counter()
+    try:
+        data = source.fetch()
+    except Exception:
+        logging.exception(f"Source '{source.name}' failed")
+        data = None
+    return data, time.perf_counter() - start
+
+def run_sources(sources):
+    """Fetches all sources in parallel, reusing cached results that are still fresh.
+
+    Returns a dict of source name -> result and a dict of source name -> fetch seconds."""
+    ttls = getattr(config, 'SOURCE_CACHE_TTLS', {})
+    max_workers = getattr(config, 'SOURCE_MAX_WORKERS', 4)
+    timeout = getattr(config, 'SOURCE_TIMEOUT', 120)
+
+    cache = load_source_cache()
+    now = time.time()
+    results = {}
+    timings = {}
+    pending = {}
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    for source in sources:
+        ttl = ttls.get(source.name, source.cache_ttl)
+        cached = cache.get(source.name)
+        if ttl and cached and now - cached['fetched_at'] < ttl:
+            logging.info(f"Using cached result for '{source.name}'.")
+            results[source.name] = cached['data']
+            timings[source.name] = 0.0
+            continue
+        pending[executor.submit(_timed_fetch, source)] = source
+
+    done, not_done = wait(pending, timeout=timeout)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    cache_updated = False
+    for future in done:
+        source = pending[future]
+        data, elapsed = future.result()
+        timings[source.name] = elapsed
+        logging.info(f"Source '{source.name}' fetched in {elapsed:.2f}s")
+        results[source.name] = data
+        ttl = ttls.get(source.name, source.cache_ttl)
+        if ttl and data:
+            cache[source.name] = {"fetched_at": now, "data": data}
+            cache_updated = True
+    for future in not_done:
+        logging.warning(f"Source '{pending[future].name}' did not finish within {timeout}s. Skipping.")
+
+    if cache_updated:
+        save_source_cache(cache)
+    return results, timings
+
+class TokenBucket:
+    """Allows `per_minute` units per minute, refilled continuously."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` units are available (a request larger than the bucket waits for a full one)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+class GeminiScheduler:
+    """Routes every Gemini call through per-model RPM/TPM token buckets, a daily request
+    quota persisted in LLM_USAGE_FILE, and a cap on concurrent requests.
+
+    Models are tried in the order configured. A call moves on to the next model when
+    the current one is out of daily quota, would have to wait longer than max_wait for
+    budget, returns a 429, or doesn't answer within request_timeout. Models whose last
+    call took longer than latency_threshold are only used when no faster one is free."""
+
+    def __init__(self, models, max_concurrency=2, latency_threshold=30, max_wait=10, request_timeout=300):
+        self.models = models
+        self.requests = {name: TokenBucket(limits['rpm']) for name, limits in models.items()}
+        self.tokens = {name: TokenBucket(limits['tpm']) for name, limits in models.items()}
+        self.latency = {}
+        self.cooldown_until = {}
+        self.latency_threshold = latency_threshold
+        self.max_wait = max_wait
+        self.request_timeout = request_timeout
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.usage = self._load_usage()
+
+    def _load_usage(self):
+        today = datetime.now().strftime('%Y-%m-%d')
+        usage = {"date": today, "models": {}}
+        if os.path.exists(LLM_USAGE_FILE):
+            try:
+                with open(LLM_USAGE_FILE, 'r') as f:
+                    saved = json.load(f)
+                if saved.get('date') == today:
+                    usage = saved
+            except Exception:
+                logging.exception("Error reading LLM usage file")
+        return usage
+
+    def _save_usage(self):
+        try:
+            with open(LLM_USAGE_FILE, 'w') as f:
+                json.dump(self.usage, f)
+        except Exception:
+            logging.exception("Error saving LLM usage file")
+
+    def _model_usage(self, name):
+        return self.usage["models"].setdefault(name, {"requests": 0, "tokens": 0})
+
+    def _wait_time(self, name, tokens):
+        return max(self.requests[name].wait_time(1), self.tokens[name].wait_time(tokens))
+
+    def _reserve(self, tokens, exclude):
+        """Picks a model and takes its budget, waiting if needed. Returns the model name."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                available = [
+                    name for name in self.models
+                    if name not in exclude
+                    and self._model_usage(name)["requests"] < self.models[name]['rpd']
+                    and self.cooldown_until.get(name, 0) <= now
+                ]
+                if not available:
+                    raise RuntimeError("No Gemini model is available within its quota")
+                waits = {name: self._wait_time(name, tokens) for name in available}
+                preferred = [
+                    name for name in available
+                    if waits[name] <= self.max_wait and self.latency.get(name, 0) <= self.latency_threshold
+                ]
+                name = preferred[0] if preferred else min(available, key=waits.get)
+                if waits[name] == 0:
+                    self.requests[name].take(1)
+                    self.tokens[name].take(tokens)
+                    self._model_usage(name)["requests"] += 1
+                    return name
+            logging.debug(f"Waiting {waits[name]:.1f}s for Gemini budget on {name}")
+            time.sleep(waits[name])
+
+    def _record(self, name, tokens, reserved_tokens, latency):
+        """Records a finished call. The TPM bucket was charged the prompt estimate up front;
+        any extra tokens the response reports (output included) are charged now."""
+        with self.lock:
+            self.latency[name] = latency
+            if tokens > reserved_tokens:
+                self.tokens[name].take(tokens - reserved_tokens)
+            self._model_usage(name)["tokens"] += tokens
+            self._save_usage()
+
+    def _cool_down(self, name):
+        with self.lock:
+            self.cooldown_until[name] = time.monotonic() + 60
+
+    def generate(self, prompt, generation_config=None):
+        estimated_tokens = estimate_tokens(prompt)
+        tried = []
+        last_error = None
+        with self.slots:
+            while True:
+                try:
+                    name = self._reserve(estimated_tokens, tried)
+                except RuntimeError:
+                    if last_error is None:
+                        raise
+                    raise RuntimeError(f"Every Gemini model tried failed: {', '.join(tried)}") from last_error
+                tried.append(name)
+                if name != next(iter(self.models)):
+                    logging.info(f"Using fallback Gemini model {name}")
+                start = time.monotonic()
+                used_tokens = 0
+                try:
+                    text, used_tokens = _post_gemini(name, prompt, generation_config, timeout=self.request_timeout)
+                    return text
+                except requests.exceptions.Timeout as e:
+                    last_error = e
+                    logging.warning(f"Gemini model {name} timed out after {self.request_timeout}s; trying the next model.")
+                    self._cool_down(name)
+                except requests.exceptions.HTTPError as e:
+                    if e.response is None or e.response.status_code != 429:
+                        raise
+                    last_error = e
+                    logging.warning(f"Gemini model {name} is rate limited; trying the next model.")
+                    self._cool_down(name)
+                finally:
+                    # Every attempt counts against the daily quota, whether it succeeded or not.
+                    self._record(name, used_tokens or estimated_tokens, estimated_tokens, time.monotonic() - start)
+
+
+_gemini_scheduler = None
+_gemini_scheduler_lock = threading.Lock()
+
+def get_gemini_scheduler():
+    """Returns the shared GeminiScheduler, creating it from config on first use."""
+    global _gemini_scheduler
+    with _gemini_scheduler_lock:
+        if _gemini_scheduler is None:
+            _gemini_scheduler = GeminiScheduler(
+                getattr(config, 'GEMINI_MODELS', DEFAULT_GEMINI_MODELS),
+                max_concurrency=getattr(config, 'GEMINI_MAX_CONCURRENCY', 2),
+                latency_threshold=getattr(config, 'GEMINI_LATENCY_THRESHOLD', 30),
+                max_wait=getattr(config, 'GEMINI_MAX_WAIT', 10),
+                request_timeout=getattr(config, 'GEMINI_REQUEST_TIMEOUT', 300),
+            )
+        return _gemini_scheduler
+
+def _post_gemini(model_name, prompt, generation_config=None, timeout=None):
+    """Makes one generateContent call and returns the text and the total tokens reported."""
     api_key = config.GEMINI_API_KEY
-    model_name = "gemini-2.5-flash"
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
+    url = f"{GEMINI_API_URL}/models/{model_name}:generateContent?key={api_key}"
     headers = {'Content-Type': 'application/json'}
 
-    # Build user preferences section if feedback context exists
-    preferences_section = ""
-    if feedback_context:
-        preferences_section = f"""
+    body = {
+        "contents": [{
+            "parts": [{
+                "text": prompt
+            }]
+        }]
+    }
+    if generation_config:
+        body["generationConfig"] = generation_config
+
+    response = requests.post(url, headers=headers, data=json.dumps(body), timeout=timeout)
+    response.raise_for_status()
+    
+    response_data = response.json()
+    used_tokens = response_data.get('usageMetadata', {}).get('totalTokenCount', 0)
+    return response_data['candidates'][0]['content']['parts'][0]['text'], used_tokens
+
+def gemini_generate(prompt, generation_config=None):
+    """Sends a prompt to Gemini using a direct requests call and returns the generated text.
+    Not using the Google client library due to issues getting that working on some hardware."""
+    return get_gemini_scheduler().generate(prompt, generation_config)
+
+def build_preferences_section(feedback_context):
+    """Builds the user preferences block of the summary prompt, if feedback context exists."""
+    if not feedback_context:
+        return ""
+    return f"""
     USER PREFERENCES (use these to guide your selections):
     {feedback_context}
     
     Apply these preferences when selecting and prioritizing stories.
     """
 
+def get_ai_summary(content_to_summarize, feedback_context=""):
+    """Sends content to Gemini AI for summarization and returns the HTML it writes."""
+    logging.info("Sending content to Gemini for summarization via requests...")
+
+    preferences_section = build_preferences_section(feedback_context)
+
     prompt = f"""
     You are my personalized news digest assistant. Your task is to review a list of headlines and their accompanying content, then create a clean and insightful HTML email digest.
     {preferences_section}
@@ -486,36 +1565,130 @@ def get_ai_summary(content_to_summarize, feedback_context=""):
     {content_to_summarize}
     """
 
-    body = {
-        "contents": [{
-            "parts": [{
-                "text": prompt
-            }]
-        }]
-    }
-
     try:
         logging.debug("Prompting Gemini model via REST API...")
-        response = requests.post(url, headers=headers, data=json.dumps(body))
-        response.raise_for_status()
-        
-        response_data = response.json()
-        generated_text = response_data['candidates'][0]['content']['parts'][0]['text']
-        
+        generated_text = gemini_generate(prompt)
         logging.info("Successfully received summary from Gemini.")
         return generated_text
     except Exception:
         logging.exception("Error communicating with Gemini API via requests")
-        return f"<h2>Error</h2><p>Could not generate AI summary. See digest.log for details.</p>"
+        return AI_SUMMARY_ERROR_HTML
 
-def send_email(html_content):
-    """Connects to an SMTP server and sends the email."""
+# Gemini returns only the IDs of the stories it picked plus one summary sentence each;
+# titles and links come from our own data when the HTML is rendered.
+NEWS_SELECTION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "categories": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "name": {"type": "STRING"},
+                    "stories": {
+                        "type": "ARRAY",
+                        "items": {
+                            "type": "OBJECT",
+                            "properties": {
+                                "id": {"type": "STRING"},
+                                "summary": {"type": "STRING"},
+                            },
+                            "required": ["id"],
+                        },
+                    },
+                },
+                "required": ["name", "stories"],
+            },
+        },
+    },
+    "required": ["categories"],
+}
+
+def number_news_items(sections):
+    """Assigns each news item a short ID and returns the prompt listing plus an ID -> item map."""
+    items_by_id = {}
+    listing = ""
+    for section in sections:
+        listing += f"## {section['category']}\n"
+        for item in section['items']:
+            item_id = str(len(items_by_id) + 1)
+            items_by_id[item_id] = item
+            listing += f"[{item_id}] {item['title']}\n"
+            if item.get('type'):
+                listing += f"  Type: {item['type']}\n"
+            listing += f"  Content: {item['content']}\n"
+        listing += "\n"
+    return listing, items_by_id
+
+def render_news_selection(selection, items_by_id):
+    """Renders Gemini's story selection as HTML using our own titles and links."""
+    out = io.StringIO()
+    seen = set()
+    for category in selection.get('categories', []):
+        stories = []
+        for story in category.get('stories', []):
+            item = items_by_id.get(str(story.get('id')))
+            if not item or id(item) in seen:
+                continue
+            seen.add(id(item))
+            stories.append((item, story.get('summary', "")))
+        if not stories:
+            continue
+        NEWS_CATEGORY_HTML.render_to(out, name=category.get('name', ""))
+        for item, summary in stories:
+            NEWS_STORY_HTML.render_to(out, link=item['link'], title=item['title'])
+            if summary and item.get('type') != "Link/Image Post":
+                NEWS_SUMMARY_HTML.render_to(out, summary=summary)
+            out.write("</li>")
+        out.write("</ul>")
+    return out.getvalue()
+
+def get_structured_ai_summary(sections, feedback_context=""):
+    """Asks Gemini for a JSON story selection and renders the digest HTML locally."""
+    logging.info("Sending content to Gemini for a structured story selection...")
+
+    listing, items_by_id = number_news_items(sections)
+    preferences_section = build_preferences_section(feedback_context)
+
+    prompt = f"""
+    You are my personalized news digest assistant. Your task is to review a list of numbered headlines and their accompanying content, then pick the stories for my email digest.
+    {preferences_section}
+    Instructions:
+    1.  Review the headlines and content for each category provided below. If the same news story appears in multiple categories, please only include it once.
+    2.  For each category, select the 3-5 most interesting or important stories. Prioritize based on user preferences if provided.
+    3.  For each selected story, return its number as "id" and write a single, engaging summary sentence. This summary MUST NOT simply rephrase the headline. It should provide a unique insight from the provided content.
+    4.  IMPORTANT EXCEPTION: If an item is marked "Type: Link/Image Post", leave its summary empty.
+    5.  Use the category names exactly as given. Do not repeat titles or links.
+
+    Here is the list of headlines and content to analyze:
+    {listing}
+    """
+
+    try:
+        logging.debug("Prompting Gemini model for JSON output...")
+        generated_text = gemini_generate(prompt, {
+            "responseMimeType": "application/json",
+            "responseSchema": NEWS_SELECTION_SCHEMA,
+        })
+        selection = json.loads(generated_text)
+        logging.info("Successfully received story selection from Gemini.")
+        return render_news_selection(selection, items_by_id)
+    except Exception:
+        logging.exception("Error getting structured story selection from Gemini")
+        return AI_SUMMARY_ERROR_HTML
+
+def send_email(html_content, text_content=None):
+    """Connects to an SMTP server and sends the email with HTML and plain-text parts."""
     logging.info("Preparing to send email...")
+    if text_content is None:
+        text_content = html_to_text(html_content)
     msg = MIMEMultipart('alternative')
     today_date = datetime.now().strftime("%B %d, %Y")
     msg['Subject'] = f"Your Daily Digest - {today_date}"
     msg['From'] = config.EMAIL_SENDER
     msg['To'] = config.EMAIL_RECEIVER
+    # Clients show the last alternative they support, so the HTML part goes last.
+    msg.attach(MIMEText(text_content, 'plain'))
     msg.attach(MIMEText(html_content, 'html'))
     try:
         with smtplib.SMTP(config.SMTP_SERVER, config.SMTP_PORT) as server:
@@ -528,76 +1701,44 @@ def send_email(html_content):
 
 def main():
     """Main function to run the digest creation process."""
-    logging.info("--- Starting the daily digest script ---")
+    run_id = new_run_id()
+    logging.info(f"--- Starting the daily digest script (run {run_id}) ---")
     
     # --- STEP 0: Check for feedback from yesterday's newsletter ---
-    feedback = check_for_feedback()
-    if feedback:
-        logging.info("Processing user feedback...")
-        process_and_update_feedback(feedback)
-    
-    # Load current feedback context for use in AI summary
-    feedback_context = load_feedback_context()
+    # IMAP and the feedback Gemini calls run in the background while content is
+    # fetched; only the AI summary needs to wait for the updated context.
+    feedback_executor = ThreadPoolExecutor(max_workers=1)
+    feedback_future = feedback_executor.submit(refresh_feedback_context)
+    feedback_executor.shutdown(wait=False)
     
     # --- STEP 1: Gather all content ---
-    financial_html = ""
-    if hasattr(config, 'FINNHUB_API_KEY') and config.FINNHUB_API_KEY and hasattr(config, 'FINANCIAL_ASSETS'):
-        financial_html = get_financial_data(config.FINNHUB_API_KEY, config.FINANCIAL_ASSETS)
+    sources = load_sources()
+    results, _ = run_sources(sources)
     
-    weather_html = get_weather_forecast(config.NWS_FORECAST_URL)
-    nasa_data = get_nasa_image_of_the_day()
-    wiki_data = get_wikipedia_article_of_the_day()
-    xkcd_data = get_latest_xkcd()
-    reddit_content = get_reddit_json_content(config.REDDIT_JSON_FEEDS)
-    rss_content = get_rss_content(config.GENERAL_RSS_FEEDS)
+    # Wait for the current feedback context for use in AI summary
+    feedback_context = feedback_future.result()
     
     # --- STEP 2: Get the AI summary for the text news ---
-    full_content_for_ai = reddit_content + rss_content
+    news_sources = [source for source in sources if source.summarize and results.get(source.name)]
+    full_content_for_ai = "".join(source.prompt_text(results[source.name]) for source in news_sources)
     ai_html_body = ""
-    if full_content_for_ai.strip():
-        ai_html_body = get_ai_summary(full_content_for_ai, feedback_context)  # Pass context!
-    else:
+    if not full_content_for_ai.strip():
         logging.warning("No text-based news content gathered to send to AI.")
+    elif getattr(config, 'GEMINI_STRUCTURED_OUTPUT', False):
+        news_sections = [section for source in news_sources for section in results[source.name]]
+        ai_html_body = get_structured_ai_summary(news_sections, feedback_context)
+    else:
+        ai_html_body = get_ai_summary(full_content_for_ai, feedback_context)  # Pass context!
 
     # --- STEP 3: Build the final email body ---
-    final_html_content = financial_html + weather_html
-
-    if nasa_data:
-        final_html_content += f"""
-            <h1>Image of the Day: {nasa_data['title']}</h1>
-            <p><img src="{nasa_data['image_url']}" alt="{nasa_data['title']}" style="max-width:100%; height:auto;" /></p>
-            <p>{nasa_data['description']}</p>
-        """
-    
-    if wiki_data:
-        final_html_content += f"""
-            <hr><h1>Wikipedia Article of the Day</h1>
-            <h2><a href="{wiki_data['url']}">{wiki_data['title']}</a></h2>
-        """
-        if wiki_data.get('image_url'):
-            final_html_content += f"""
-                <p><img src="{wiki_data['image_url']}" alt="{wiki_data['title']}" style="max-width:100%; height:auto;" /></p>
-            """
-        final_html_content += f"<p>{wiki_data['intro']}</p>"
-
-    if ai_html_body:
-        final_html_content += f"<hr><h1>Your News Digest</h1>{ai_html_body}"
-
-    if xkcd_data:
-        final_html_content += f"""
-            <hr>
-            <h1>Daily Comic: xkcd</h1>
-            <h2>{xkcd_data['title']}</h2>
-            <p><img src="{xkcd_data['image_url']}" alt="{xkcd_data['title']}" style="max-width:100%; height:auto;" /></p>
-            <p><i>{xkcd_data['alt_text']}</i></p>
-        """
+    final_html_content, final_text_content = render_digest(sources, results, ai_html_body)
 
     # --- STEP 4: Send the email ---
     if not final_html_content.strip():
         logging.warning("No content at all was generated. Exiting without sending email.")
         return
 
-    send_email(final_html_content)
+    send_email(final_html_content, final_text_content)
     
     logging.info("--- Digest script finished ---")
 
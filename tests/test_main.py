@@ -7,6 +7,12 @@ from unittest.mock import Mock
 from datetime import datetime, timezone
 import main
 
+@pytest.fixture(autouse=True)
+def isolated_gemini_scheduler(mocker, tmp_path):
+    # Keep Gemini usage counters out of the repo and start each test with fresh budgets.
+    mocker.patch('main.LLM_USAGE_FILE', str(tmp_path / 'llm_usage.json'))
+    mocker.patch('main._gemini_scheduler', None)
+
 def test_get_financial_data(mocker):
     # Mock the requests.get call
     mock_response = Mock()
@@ -241,3 +247,415 @@ def test_send_email(mocker):
     mock_server.starttls.assert_called_once()
     mock_server.login.assert_called_once()
     mock_server.sendmail.assert_called_once()
+
+def test_load_sources_skips_unknown_and_unconfigured(mocker):
+    mocker.patch.object(main.config, 'DIGEST_SOURCES', ['nasa', 'weather', 'no_such_module.Source'], create=True)
+    mocker.patch.object(main.config, 'NWS_FORECAST_URL', '')
+
+    sources = main.load_sources()
+
+    assert [source.name for source in sources] == ['nasa']
+
+def test_load_sources_skips_source_without_fetch(mocker):
+    class BrokenSource(main.Source):
+        name = 'broken'
+
+    mocker.patch.dict(main.SOURCE_REGISTRY, {'broken': BrokenSource})
+    mocker.patch.object(main.config, 'DIGEST_SOURCES', ['broken', 'nasa'], create=True)
+
+    sources = main.load_sources()
+
+    assert [source.name for source in sources] == ['nasa']
+
+def test_run_sources_uses_fresh_cache(mocker, tmp_path):
+    mocker.patch('main.SOURCE_CACHE_FILE', str(tmp_path / 'source_cache.json'))
+    mocker.patch.object(main.config, 'SOURCE_CACHE_TTLS', {'test': 3600}, create=True)
+
+    class TestSource(main.Source):
+        name = 'test'
+        calls = 0
+
+        def fetch(self):
+            TestSource.calls += 1
+            return {'value': 42}
+
+    first, _ = main.run_sources([TestSource()])
+    second, timings = main.run_sources([TestSource()])
+
+    assert first == second == {'test': {'value': 42}}
+    assert TestSource.calls == 1
+    assert timings == {'test': 0.0}
+
+def test_send_email_includes_text_part(mocker):
+    mock_smtp_class = mocker.patch('smtplib.SMTP')
+    mock_server = mock_smtp_class.return_value.__enter__.return_value
+
+    main.send_email('<h1>Test Email</h1>', 'Test Email')
+
+    message = mock_server.sendmail.call_args.args[2]
+    assert 'Content-Type: text/plain' in message
+    assert 'Content-Type: text/html' in message
+
+def test_render_digest_escapes_values():
+    sources = [main.XkcdSource(), main.RssSource()]
+    results = {
+        'xkcd': {'title': 'A <b>"bold"</b> title', 'image_url': 'http://x/?a=1&b=2', 'alt_text': 'alt'},
+        'rss': [{'category': 'News', 'items': []}],
+    }
+
+    html_body, text_body = main.render_digest(sources, results, '<h2>News</h2><ul><li>Story</li></ul>')
+
+    assert '<h2>A &lt;b&gt;&quot;bold&quot;&lt;/b&gt; title</h2>' in html_body
+    assert 'src="http://x/?a=1&amp;b=2"' in html_body
+    assert '<h1>Your News Digest</h1><h2>News</h2>' in html_body
+    assert 'DAILY COMIC: xkcd - A <b>"bold"</b> title' in text_body
+    assert 'Story' in text_body
+
+def test_add_market_history(mocker, tmp_path):
+    mocker.patch('main.MARKET_HISTORY_DB', str(tmp_path / 'market_history.db'))
+    now = 1_700_000_000
+    day = 86400
+    with main.closing(main._open_market_history()) as conn:
+        for days_ago, price in [(40, 50.0), (30, 80.0), (7, 90.0), (3, 110.0)]:
+            main.record_quotes(conn, [{'symbol': 'TEST', 'price': price}, {'symbol': 'OTHER', 'price': price / 10}], now - days_ago * day)
+    mocker.patch('main.time.time', return_value=now)
+    connect = mocker.spy(main.sqlite3, 'connect')
+
+    quotes = main.add_market_history([
+        {'name': 'Test Asset', 'symbol': 'TEST', 'price': 100.0, 'change': 1.0, 'pct_change': 1.0},
+        {'name': 'Other Asset', 'symbol': 'OTHER', 'price': 10.0, 'change': 1.0, 'pct_change': 1.0},
+    ])
+
+    assert connect.call_count == 1
+    assert quotes[1]['history']['sparkline'] == [8.0, 9.0, 11.0, 10.0]
+
+    history = quotes[0]['history']
+    assert history['change_7d'] == pytest.approx(100 / 90 * 100 - 100)
+    assert history['change_30d'] == pytest.approx(25.0)
+    assert history['ma_7'] == pytest.approx(100.0)
+    assert history['sparkline'] == [80.0, 90.0, 110.0, 100.0]
+
+    result = main.render_to_string(main.render_financial_section, quotes)
+    assert '<polyline' in result
+    assert '30d: +25.00%' in result
+
+def test_load_price_history_empty_database(mocker, tmp_path):
+    mocker.patch('main.MARKET_HISTORY_DB', str(tmp_path / 'market_history.db'))
+
+    with main.closing(main._open_market_history()) as conn:
+        history = main.load_price_history(conn, ['TEST'], 0)
+
+    timestamps, prices = history['TEST']
+    assert len(timestamps) == 0
+    assert len(prices) == 0
+
+def test_refresh_feedback_context(mocker):
+    mocker.patch('main.check_for_feedback', return_value='More science please')
+    mock_process = mocker.patch('main.process_and_update_feedback', return_value='# User Preferences')
+    mock_load = mocker.patch('main.load_feedback_context', return_value='old context')
+
+    assert main.refresh_feedback_context() == '# User Preferences'
+    mock_process.assert_called_once_with('More science please')
+    mock_load.assert_not_called()
+
+    mocker.patch('main.check_for_feedback', return_value=None)
+    assert main.refresh_feedback_context() == 'old context'
+
+def test_get_structured_ai_summary(mocker):
+    selection = {
+        'categories': [
+            {'name': 'News', 'stories': [
+                {'id': '2', 'summary': 'Why it matters.'},
+                {'id': '1', 'summary': 'Should be dropped.'},
+                {'id': '99', 'summary': 'Unknown id.'},
+            ]},
+        ]
+    }
+    mock_response = Mock()
+    mock_response.json.return_value = {
+        'candidates': [{'content': {'parts': [{'text': main.json.dumps(selection)}]}}]
+    }
+    mock_response.raise_for_status.return_value = None
+    mock_post = mocker.patch('requests.post', return_value=mock_response)
+
+    sections = [{'category': 'News', 'items': [
+        {'title': 'Cat <3 pic', 'link': 'https://example.com/1', 'type': 'Link/Image Post', 'content': ''},
+        {'title': 'Big story', 'link': 'https://example.com/2?a=1&b=2', 'content': 'Details.'},
+    ]}]
+    result = main.get_structured_ai_summary(sections)
+
+    body = main.json.loads(mock_post.call_args.kwargs['data'])
+    assert body['generationConfig']['responseMimeType'] == 'application/json'
+    assert '[2] Big story' in body['contents'][0]['parts'][0]['text']
+    assert result.startswith('<h2>News</h2><ul>')
+    assert '<a href="https://example.com/2?a=1&amp;b=2">Big story</a><p style="font-size:smaller;"><i>Why it matters.</i></p>' in result
+    assert '<a href="https://example.com/1">Cat &lt;3 pic</a></li>' in result
+    assert 'Should be dropped' not in result
+    assert 'Unknown id' not in result
+
+def test_fetch_reddit_posts_combines_subreddits(mocker):
+    def post(subreddit, title):
+        return {'data': {'subreddit': subreddit, 'title': title, 'permalink': f'/r/{subreddit}/{title}/',
+                         'is_self': False, 'preview': {'images': ['big']}}}
+
+    mock_response = Mock()
+    mock_response.json.return_value = {'data': {'children': [
+        post('funny', 'a'), post('Science', 'b'), post('funny', 'c'),
+    ]}}
+    mock_response.raise_for_status.return_value = None
+    mock_get = mocker.patch('requests.get', return_value=mock_response)
+
+    feeds = {
+        'Funny': 'https://www.reddit.com/r/funny/top/.json?t=day',
+        'Science': 'https://www.reddit.com/r/science/top/.json?t=day',
+    }
+    result = main.fetch_reddit_posts(feeds)
+
+    mock_get.assert_called_once()
+    assert mock_get.call_args.args[0] == 'https://www.reddit.com/r/funny+science/top/.json?t=day'
+    assert mock_get.call_args.kwargs['params'] == {'limit': 10}
+    assert [section['category'] for section in result] == ['Funny', 'Science']
+    assert [item['title'] for item in result[0]['items']] == ['a', 'c']
+    assert [item['title'] for item in result[1]['items']] == ['b']
+    assert 'preview' not in result[0]['items'][0]
+
+def test_json_log_records_carry_run_id():
+    record = main.logging.LogRecord('test', main.logging.WARNING, __file__, 1, 'Feed %s failed', ('NPR',), None)
+    main.RunIdFilter().filter(record)
+
+    entry = main.json.loads(main.JsonFormatter().format(record))
+
+    assert entry['run_id'] == main.RUN_ID
+    assert entry['level'] == 'WARNING'
+    assert entry['message'] == 'Feed NPR failed'
+
+def test_new_run_id_tags_later_records(mocker):
+    mocker.patch('main.RUN_ID', 'previous-run')
+    record = main.logging.LogRecord('test', main.logging.INFO, __file__, 1, 'Starting', None, None)
+
+    run_id = main.new_run_id()
+    main.RunIdFilter().filter(record)
+
+    assert run_id != 'previous-run'
+    assert record.run_id == run_id
+
+def test_get_weather_forecasts_caches_gridpoints_and_forecasts(mocker, tmp_path):
+    mocker.patch('main.WEATHER_CACHE_FILE', str(tmp_path / 'weather_cache.json'))
+
+    def fake_get(url, headers=None):
+        response = Mock()
+        response.raise_for_status.return_value = None
+        response.headers = {'Cache-Control': 'public, max-age=3600'}
+        if '/points/' in url:
+            gridpoint = url.rsplit('/', 1)[1]
+            response.json.return_value = {'properties': {
+                'forecast': f'https://api.weather.gov/gridpoints/{gridpoint}/forecast',
+                'forecastHourly': f'https://api.weather.gov/gridpoints/{gridpoint}/forecast/hourly',
+            }}
+        else:
+            response.json.return_value = {'properties': {'periods': [{
+                'name': 'Today', 'startTime': '2026-10-19T14:00:00-04:00', 'temperature': 65,
+                'temperatureUnit': 'F', 'shortForecast': 'Sunny', 'detailedForecast': 'Sunny skies.',
+            }]}}
+        return response
+
+    mock_get = mocker.patch('requests.get', side_effect=fake_get)
+    locations = [{'name': 'Home', 'lat': 38.8894, 'lon': -77.0352}, {'name': 'Cabin', 'lat': 44.0, 'lon': -71.5}]
+
+    first = main.get_weather_forecasts(locations, include_hourly=True)
+    assert mock_get.call_count == 6
+    second = main.get_weather_forecasts(locations, include_hourly=True)
+    assert mock_get.call_count == 6
+
+    assert first == second
+    assert [location['name'] for location in first] == ['Home', 'Cabin']
+    result = main.render_to_string(main.render_weather_section, first)
+    assert '<h2>Home</h2>' in result
+    assert '<td>2 PM</td><td>65°F</td><td>Sunny</td>' in result
+
+def test_gemini_scheduler_falls_back_on_rate_limit(mocker):
+    def fake_post(url, headers=None, data=None, timeout=None):
+        response = Mock()
+        if '/models/primary:' in url:
+            response.raise_for_status.side_effect = main.requests.exceptions.HTTPError(response=Mock(status_code=429))
+        else:
+            response.raise_for_status.return_value = None
+            response.json.return_value = {
+                'candidates': [{'content': {'parts': [{'text': 'fallback answer'}]}}],
+                'usageMetadata': {'totalTokenCount': 42},
+            }
+        return response
+
+    mock_post = mocker.patch('requests.post', side_effect=fake_post)
+    models = {
+        'primary': {'rpm': 10, 'tpm': 100000, 'rpd': 100},
+        'fallback': {'rpm': 10, 'tpm': 100000, 'rpd': 100},
+    }
+    scheduler = main.GeminiScheduler(models)
+
+    assert scheduler.generate('hello') == 'fallback answer'
+    assert mock_post.call_count == 2
+    # The rate-limited model is skipped while it cools down.
+    assert scheduler.generate('hello again') == 'fallback answer'
+    assert mock_post.call_count == 3
+
+    usage = main.json.load(open(main.LLM_USAGE_FILE))
+    assert usage['models']['primary']['requests'] == 1
+    assert usage['models']['fallback'] == {'requests': 2, 'tokens': 84}
+
+def test_gemini_scheduler_respects_persisted_daily_quota(mocker):
+    with open(main.LLM_USAGE_FILE, 'w') as f:
+        main.json.dump({'date': datetime.now().strftime('%Y-%m-%d'), 'models': {'primary': {'requests': 5, 'tokens': 0}}}, f)
+    mock_post = mocker.patch('requests.post')
+    scheduler = main.GeminiScheduler({'primary': {'rpm': 10, 'tpm': 100000, 'rpd': 5}})
+
+    with pytest.raises(RuntimeError):
+        scheduler.generate('hello')
+    mock_post.assert_not_called()
+
+def test_token_bucket_wait_time(mocker):
+    clock = mocker.patch('main.time.monotonic', return_value=100.0)
+    bucket = main.TokenBucket(60)
+
+    bucket.take(60)
+    assert bucket.wait_time(30) == pytest.approx(30.0)
+    clock.return_value = 130.0
+    assert bucket.wait_time(30) == 0.0
+
+def test_fetch_reddit_posts_keeps_combined_posts_when_refetch_fails(mocker):
+    def post(subreddit, title):
+        return {'data': {'subreddit': subreddit, 'title': title, 'permalink': f'/r/{subreddit}/{title}/', 'is_self': False}}
+
+    def fake_get(url, headers=None, params=None):
+        response = Mock()
+        if 'funny+science' in url:
+            response.raise_for_status.return_value = None
+            response.json.return_value = {'data': {'children': [post('funny', str(i)) for i in range(9)] + [post('science', 's')]}}
+        else:
+            response.raise_for_status.side_effect = main.requests.exceptions.HTTPError('500 Server Error')
+        return response
+
+    mock_get = mocker.patch('requests.get', side_effect=fake_get)
+    feeds = {
+        'Funny': 'https://www.reddit.com/r/funny/top/.json?t=day',
+        'Science': 'https://www.reddit.com/r/science/top/.json?t=day',
+    }
+    result = main.fetch_reddit_posts(feeds)
+
+    assert mock_get.call_count == 2
+    assert [section['category'] for section in result] == ['Funny', 'Science']
+    assert len(result[0]['items']) == 5
+    assert [item['title'] for item in result[1]['items']] == ['s']
+
+def test_fetch_reddit_posts_falls_back_to_single_subreddits(mocker):
+    def fake_get(url, headers=None, params=None):
+        response = Mock()
+        if 'funny+science' in url or '/r/music/' in url:
+            response.raise_for_status.side_effect = main.requests.exceptions.HTTPError('503 Server Error')
+        else:
+            subreddit = url.split('/r/')[1].split('/')[0]
+            response.raise_for_status.return_value = None
+            response.json.return_value = {'data': {'children': [
+                {'data': {'subreddit': subreddit, 'title': subreddit, 'permalink': f'/r/{subreddit}/1/', 'is_self': False}}
+            ]}}
+        return response
+
+    mock_get = mocker.patch('requests.get', side_effect=fake_get)
+    feeds = {
+        'Funny': 'https://www.reddit.com/r/funny/top/.json?t=day',
+        'Science': 'https://www.reddit.com/r/science/top/.json?t=day',
+        'Music': 'https://www.reddit.com/r/music/top/.json?t=day',
+    }
+    result = main.fetch_reddit_posts(feeds)
+
+    assert mock_get.call_count == 4
+    assert [section['category'] for section in result] == ['Funny', 'Science']
+    assert [item['title'] for item in result[1]['items']] == ['science']
+
+def test_queued_json_log_keeps_exception_separate():
+    log_queue = main.queue.SimpleQueue()
+    queue_handler = main.StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(main.RunIdFilter())
+    output = main.io.StringIO()
+    json_handler = main.logging.StreamHandler(output)
+    json_handler.setFormatter(main.JsonFormatter())
+    listener = main.QueueListener(log_queue, json_handler)
+    logger = main.logging.getLogger('test_queued_json_log')
+    logger.propagate = False
+    logger.addHandler(queue_handler)
+
+    listener.start()
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("Feed %s failed", "NPR")
+    listener.stop()
+    logger.removeHandler(queue_handler)
+
+    entry = main.json.loads(output.getvalue())
+    assert entry['run_id'] == main.RUN_ID
+    assert entry['message'] == 'Feed NPR failed'
+    assert 'ValueError: boom' in entry['exception']
+
+def test_gemini_scheduler_falls_back_on_timeout_and_charges_output_tokens(mocker):
+    def fake_post(url, headers=None, data=None, timeout=None):
+        assert timeout == 5
+        if '/models/primary:' in url:
+            raise main.requests.exceptions.ReadTimeout()
+        response = Mock()
+        response.raise_for_status.return_value = None
+        response.json.return_value = {
+            'candidates': [{'content': {'parts': [{'text': 'fallback answer'}]}}],
+            'usageMetadata': {'totalTokenCount': 600},
+        }
+        return response
+
+    mocker.patch('requests.post', side_effect=fake_post)
+    mocker.patch('main.time.monotonic', return_value=100.0)
+    models = {
+        'primary': {'rpm': 10, 'tpm': 1000, 'rpd': 100},
+        'fallback': {'rpm': 10, 'tpm': 1000, 'rpd': 100},
+    }
+    scheduler = main.GeminiScheduler(models, request_timeout=5)
+
+    assert scheduler.generate('hello') == 'fallback answer'
+    # The full 600 reported tokens come out of the fallback's TPM bucket, not just the prompt estimate.
+    assert scheduler.tokens['fallback'].tokens == pytest.approx(400)
+    assert scheduler.cooldown_until['primary'] == 160.0
+
+def test_digest_template_rejects_format_specs():
+    with pytest.raises(ValueError):
+        main.DigestTemplate("<b>{price:,.2f}</b>")
+    with pytest.raises(ValueError):
+        main.DigestTemplate("<b>{name!r}</b>")
+
+def test_gemini_scheduler_reports_failed_models_and_prefers_fast_ones(mocker):
+    def fake_post(url, headers=None, data=None, timeout=None):
+        raise main.requests.exceptions.ReadTimeout()
+
+    mocker.patch('requests.post', side_effect=fake_post)
+    models = {
+        'primary': {'rpm': 10, 'tpm': 100000, 'rpd': 100},
+        'fallback': {'rpm': 10, 'tpm': 100000, 'rpd': 100},
+    }
+    scheduler = main.GeminiScheduler(models)
+
+    with pytest.raises(RuntimeError, match='tried failed: primary, fallback'):
+        scheduler.generate('hello')
+
+    scheduler = main.GeminiScheduler(models, latency_threshold=30)
+    scheduler.latency['primary'] = 45
+    assert scheduler._reserve(1, []) == 'fallback'
+
+def test_gemini_scheduler_records_usage_when_response_is_blocked(mocker):
+    response = Mock()
+    response.raise_for_status.return_value = None
+    response.json.return_value = {'promptFeedback': {'blockReason': 'SAFETY'}}
+    mocker.patch('requests.post', return_value=response)
+    scheduler = main.GeminiScheduler({'primary': {'rpm': 10, 'tpm': 100000, 'rpd': 100}})
+
+    with pytest.raises(KeyError):
+        scheduler.generate('hello')
+
+    usage = main.json.load(open(main.LLM_USAGE_FILE))
+    assert usage['models']['primary']['requests'] == 1